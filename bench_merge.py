@@ -0,0 +1,86 @@
+"""
+Benchmark of merging deeply nested dictionaries
+
+Compares `apply_patch` (recursive up to `merge.RECURSION_DEPTH` levels, explicit
+stack below) with a fully recursive merge (the same code without the depth
+limit: one call per nesting level, RecursionError on deep nesting) on chains of
+nested dicts, reporting the time per nesting level
+
+Usage:
+    python bench_merge.py [--depths 10 100 500] [--repeat 200]
+"""
+
+import sys
+import timeit
+import argparse
+
+import merge
+from merge import Patch, apply_patch
+
+
+def make_chain(depth: int, leaf: dict) -> dict:
+    """
+    Return `depth` nested dicts ({"vrf": {"vrf": ... leaf}}) with a few siblings
+    on every level
+    """
+    data = leaf
+    for level in range(depth):
+        data = {"vrf": data, "name": f"level{level}", "asn": level}
+    return data
+
+
+def bench(depth: int, repeat: int) -> tuple[float, float | None]:
+    """
+    Return the time (seconds) per nesting level of `apply_patch` and the fully
+    recursive merge (best of 5 measurements, None if the recursive merge fails)
+    """
+    base = make_chain(depth, {"neighbor": "10.0.0.1", "remote_as": 65000})
+    patch = Patch.compile(make_chain(depth, {"remote_as": 65001}))
+
+    def measure() -> float:
+        times = timeit.repeat(
+            lambda: apply_patch(base, patch, own_override=True),
+            number=repeat,
+            repeat=5,
+        )
+        return min(times) / (repeat * depth)
+
+    current = measure()
+    # Same code without the depth limit: recursion on every level
+    recursion_depth = merge.RECURSION_DEPTH
+    merge.RECURSION_DEPTH = sys.maxsize
+    try:
+        recursive = measure()
+    except RecursionError:
+        recursive = None
+    finally:
+        merge.RECURSION_DEPTH = recursion_depth
+    return current, recursive
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--depths",
+        type=int,
+        nargs="+",
+        default=[10, 50, 100, 500, sys.getrecursionlimit() * 2],
+        help="Nesting depths to benchmark",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=200, help="Merges per measurement"
+    )
+    args = parser.parse_args()
+
+    print(f"{'depth':>8} {'apply_patch':>16} {'recursive':>16}")
+    for depth in args.depths:
+        current, recursive = bench(depth, args.repeat)
+        if recursive is None:
+            recursive = "RecursionError"
+        else:
+            recursive = f"{recursive * 1e9:.0f} ns/lvl"
+        print(f"{depth:>8} {current * 1e9:>9.0f} ns/lvl {recursive:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import bisect
+import itertools
+from collections.abc import Sequence
+
+
+class ChunkedList(Sequence):
+    """
+    Read-only list made of chunks (lists that are shared, never modified)
+
+    Used by the merge for large lists extended by many layers ('key__append'):
+    appending creates a new ChunkedList referencing the chunks of the previous
+    one plus the new items, so the accumulated list is never copied (instead of
+    copying it on every layer, which is quadratic in the number of layers)
+
+    Iterating (e.g. `{% for item in list %}` in templates) walks the chunks
+    directly, `len` is precomputed, indexing finds the chunk by bisection.
+    Comparison with lists, `+`, `*`, `in`, `copy`, `index`, `count`, `repr`
+    and `str` work as with lists (`copy`, `*` and slicing return lists), YAML
+    dumpers represent it as a list (see `yaml_io.YamlBackend`). Methods
+    modifying a list (`append`, `sort`, ...) are not available: merged lists
+    must not be modified anyway, but templates calling them on merged lists
+    fail once the list has `min_size` items. Use `materialize` where plain
+    lists are required (e.g. the `pprint` filter of templates)
+
+    Example:
+        >>> items = ChunkedList.concat([1, 2], [3])
+        >>> items == [1, 2, 3], items[-1], len(items)
+        (True, 3, 3)
+    """
+
+    # Size of a merged list from which appending produces a ChunkedList
+    min_size = 256
+    # Number of chunks from which they are joined into a single one
+    max_chunks = 64
+
+    __slots__ = ("_chunks", "_len", "_offsets")
+
+    def __init__(self, chunks=()):
+        self._chunks = tuple(chunk for chunk in chunks if chunk)
+        if len(self._chunks) > self.max_chunks:
+            self._chunks = (list(itertools.chain.from_iterable(self._chunks)),)
+        self._len = sum(map(len, self._chunks))
+        self._offsets = None  # Start index of every chunk (computed on indexing)
+
+    @classmethod
+    def concat(cls, items, new_items: list) -> "ChunkedList":
+        """
+        Return `items` (a list or a ChunkedList) followed by `new_items`,
+        sharing both (they must not be modified afterwards)
+        """
+        return cls(chunks_of(items) + (new_items,))
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._chunks)
+
+    def __reversed__(self):
+        for chunk in reversed(self._chunks):
+            yield from reversed(chunk)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("list index out of range")
+        if self._offsets is None:
+            lengths = map(len, self._chunks)
+            self._offsets = list(itertools.accumulate(lengths, initial=0))
+        chunk = bisect.bisect_right(self._offsets, index) - 1
+        return self._chunks[chunk][index - self._offsets[chunk]]
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, (list, ChunkedList)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __add__(self, other) -> "ChunkedList":
+        if not isinstance(other, (list, ChunkedList)):
+            return NotImplemented
+        return ChunkedList(self._chunks + chunks_of(other, copy=True))
+
+    def __radd__(self, other) -> "ChunkedList":
+        if not isinstance(other, (list, ChunkedList)):
+            return NotImplemented
+        return ChunkedList(chunks_of(other, copy=True) + self._chunks)
+
+    def __mul__(self, count: int) -> list:
+        return list(self) * count
+
+    __rmul__ = __mul__
+
+    def copy(self) -> list:
+        """
+        Return the items as a (new) list
+        """
+        return list(self)
+
+    def __repr__(self) -> str:
+        return repr(list(self))  # Same as a list, e.g. `{{ var }}` in templates
+
+
+def chunks_of(items, copy: bool = False) -> tuple:
+    """
+    Return chunks of a ChunkedList or a list (copied if `copy` is set, since
+    lists may be modified by their owners)
+    """
+    if isinstance(items, ChunkedList):
+        return items._chunks
+    return (list(items) if copy else items,)
+
+
+def materialize(data):
+    """
+    Return `data` with all ChunkedLists (at any depth) replaced by plain lists.
+    Dictionaries and lists containing them are copied, the rest is shared
+    """
+    if isinstance(data, ChunkedList):
+        return [materialize(item) for item in data]
+    if isinstance(data, dict):
+        result = {key: materialize(val) for key, val in data.items()}
+        if any(result[key] is not val for key, val in data.items()):
+            return result
+    elif isinstance(data, list):
+        result = [materialize(item) for item in data]
+        if any(new is not old for new, old in zip(result, data)):
+            return result
+    return data
@@ -1,9 +1,8 @@
 import logging
 from pathlib import Path
 
-import yaml
-
 from logger import Log
+from yaml_io import YamlBackend, YamlCache
 
 
 class Config:
@@ -23,10 +22,29 @@ class Config:
     filename_variable = None
 
     skip_prefix = None
+    ignore_filename = ".templaterignore"
 
     save_merged_yamls = False
     merged_yamls_path = None
 
+    max_errors = 0  # Stop after this many distinct errors (0 - never stop)
+
+    cache_dir = None  # Defaults to ".cache" inside `output_data_dir`
+    discovery_manifest = True
+    discovery_workers = 1
+    prefetch_depth = 0
+    lazy_vars = False
+
+    yaml_backend = "auto"  # "auto", "libyaml" or "python"
+    yaml_profile = "safe"  # "safe" or "inventory" (for input data only)
+    yaml_cache = True
+    yaml_cache_max_mb = 512
+    yaml_cache_trust_mtime = True
+
+    jinja_cache = True
+    compiled_templates = True
+    frozen_templates = False
+
     log_level = logging.WARNING  # 30
     log_style = "{"
     log_format = "[{asctime}] {levelname:<8} {message}"
@@ -39,6 +57,7 @@ class Config:
     }
 
     _pending_logs: list[str] = []  # Store `cls` logs until logger is initialized
+    _pending_warnings: list[str] = []  # Same for warnings
     log: Log | None = None  # Will be initialized later
 
     @classmethod
@@ -59,6 +78,9 @@ class Config:
         for msg in cls._pending_logs:
             cls.log.debug(msg)
         cls._pending_logs.clear()
+        for msg in cls._pending_warnings:
+            cls.log.warning(msg)
+        cls._pending_warnings.clear()
 
     @classmethod
     def _load_yaml(cls, path: Path):
@@ -67,7 +89,7 @@ class Config:
             return
 
         try:
-            data = yaml.safe_load(path.read_text()) or {}
+            data = YamlBackend.load_file(str(path)) or {}
         except Exception as e:
             cls._pending_logs.append(f"Skipping {path}: {e}")
             return
@@ -104,6 +126,18 @@ class Config:
             Path(cls.base_dirname) / cls.input_templates_dirname
         )
         cls.output_data_dir = str(Path(cls.base_dirname) / cls.output_data_dirname)
+        if cls.cache_dir is None:
+            cls.cache_dir = str(Path(cls.output_data_dir) / ".cache")
+
+        warning = YamlBackend.select(cls.yaml_backend, cls.yaml_profile)
+        if warning:
+            cls._pending_warnings.append(warning)
+        if cls.yaml_cache:
+            YamlBackend.cache = YamlCache(
+                str(Path(cls.cache_dir) / "yaml"),
+                max_bytes=int(cls.yaml_cache_max_mb * 2**20),
+                trust_mtime=cls.yaml_cache_trust_mtime,
+            )
 
 
 Config.apply_overrides()
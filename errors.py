@@ -0,0 +1,102 @@
+class TemplaterError(Exception):
+    """
+    Base class for errors which make a target fail without stopping the run
+
+    The run continues with the next target, and all errors are reported at the
+    end (see `ErrorReport`). An error of a file shared by several targets (e.g.
+    `vars.yaml`, a template) is raised for each of them, but reported once
+
+    Args:
+        message (str): Description of the error
+        path (str, optional): File the error is related to (may be set later,
+            by a caller knowing it)
+    """
+
+    def __init__(self, message: str, path: str | None = None):
+        super().__init__(message)
+        self.message = message
+        self.path = path
+
+    def __str__(self) -> str:
+        if self.path is None:
+            return self.message
+        return f"{self.path}: {self.message}"
+
+    def clone(self) -> "TemplaterError":
+        """
+        Return a new error of the same type, message and path, without the
+        traceback (cached errors are raised as clones, so the frames of every
+        target raising them are not kept alive by a growing traceback)
+        """
+        return type(self)(self.message, self.path)
+
+
+class YamlFileError(TemplaterError):
+    """
+    Input YAML file can not be parsed or has an unexpected structure
+    """
+
+
+class MergeError(TemplaterError):
+    """
+    Invalid merge instruction (e.g. '__append' to a non-list value)
+    """
+
+
+class TemplateError(TemplaterError):
+    """
+    Template can not be loaded or rendered
+    """
+
+
+class OutputError(TemplaterError):
+    """
+    Output file can not be written
+    """
+
+
+class ErrorReport:
+    """
+    Errors collected during a run, each with the targets it made fail
+
+    Example:
+        >>> report = ErrorReport(max_errors=10)
+        >>> report.add("cisco_ios/r1.yaml", MergeError("Can append to lists only"))
+        False
+        >>> report.lines()
+        ['[cisco_ios/r1.yaml] MergeError: Can append to lists only']
+    """
+
+    def __init__(self, max_errors: int = 0):
+        self.max_errors = max_errors  # 0 for no limit
+        # Error text: (first error, failed targets), same errors are reported once
+        self.errors: dict[str, tuple[TemplaterError, list[str]]] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.errors)
+
+    @property
+    def failed_targets(self) -> int:
+        return sum(len(targets) for _, targets in self.errors.values())
+
+    def add(self, target: str, error: TemplaterError) -> bool:
+        """
+        Record `error` which made `target` fail
+
+        Returns:
+            bool: True if the maximum number of (distinct) errors is reached
+        """
+        text = f"{type(error).__name__}: {error}"
+        self.errors.setdefault(text, (error, []))[1].append(target)
+        return 0 < self.max_errors <= len(self.errors)
+
+    def lines(self) -> list[str]:
+        """
+        Return a line per distinct error: the failed targets, its type and text
+        """
+        result = []
+        for text, (_, targets) in self.errors.items():
+            if len(targets) > 3:
+                targets = targets[:3] + [f"{len(targets) - 3} more"]
+            result.append(f"[{', '.join(targets)}] {text}")
+        return result
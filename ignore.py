@@ -0,0 +1,191 @@
+import os
+import re
+
+
+class IgnoreRules:
+    """
+    Gitignore-style patterns read from a single ignore file, compiled into one
+    combined regular expression per entry kind (files and directories)
+
+    Supported syntax (same as in `.gitignore`):
+    - Blank lines and lines starting with "#" are ignored
+    - "*" and "?" match anything except "/", "[...]" matches a character class
+    - "**" matches any number of directories ("**/archive", "a/**/b", "a/**")
+    - A trailing "/" makes the pattern match directories only
+    - A pattern with a "/" (other than the trailing one) is anchored to the
+        directory of the ignore file, otherwise it matches at any depth
+    - A leading "!" negates the pattern (re-includes previously ignored path)
+    - "\\" escapes the next character (e.g. "\\#" or "\\!")
+
+    The last matching pattern wins. Patterns are compiled in reverse order, so
+    the first matching alternative of the combined expression is the one
+    deciding the result
+
+    Example:
+        >>> rules = IgnoreRules(["**/archive/", "*.draft.yaml"], base_dir="")
+        >>> rules.match("cisco_ios/archive", is_dir=True)
+        True
+        >>> rules.match("cisco_ios/r1.yaml", is_dir=False)  # No match
+    """
+
+    def __init__(self, patterns: list[str], base_dir: str = ""):
+        self.base_dir = base_dir.replace(os.sep, "/")
+        file_rules = []
+        dir_rules = []
+        for line in patterns:
+            rule = self.parse_pattern(line)
+            if rule is None:
+                continue
+            regex, negated, dir_only = rule
+            dir_rules.append((regex, negated))
+            if not dir_only:
+                file_rules.append((regex, negated))
+        self._file_matcher = self.combine(file_rules)
+        self._dir_matcher = self.combine(dir_rules)
+
+    def __bool__(self) -> bool:
+        return self._file_matcher is not None or self._dir_matcher is not None
+
+    @classmethod
+    def from_file(cls, path: str, base_dir: str = "") -> "IgnoreRules":
+        """
+        Read patterns from the ignore file `path` located in `base_dir`
+
+        Args:
+            path (str): Path to the ignore file
+            base_dir (str): Directory of the ignore file (relative to the root
+                of the walk) the patterns are relative to
+        """
+        with open(path, "r") as file:
+            return cls(file.read().splitlines(), base_dir)
+
+    @staticmethod
+    def parse_pattern(line: str) -> tuple[str, bool, bool] | None:
+        """
+        Convert a single line of an ignore file into a regular expression
+
+        Returns:
+            tuple[str, bool, bool]: Regular expression (matching paths relative
+                to the ignore file directory), whether the pattern is negated,
+                whether it matches directories only; None for blank lines and
+                comments
+        """
+        line = line.rstrip()
+        if line.endswith("\\"):
+            line += " "  # Escaped trailing space
+        if not line or line.startswith("#"):
+            return None
+
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            return None
+
+        anchored = "/" in line
+        line = line.lstrip("/")
+        regex = translate_glob(line)
+        if not anchored:
+            regex = "(?:.*/)?" + regex
+        return regex, negated, dir_only
+
+    @staticmethod
+    def combine(rules: list[tuple[str, bool]]) -> tuple[re.Pattern, list[bool]] | None:
+        """
+        Combine (regex, negated) rules into a single expression with one group
+        per rule, last rule first
+        """
+        if not rules:
+            return None
+        rules = rules[::-1]
+        combined = re.compile("|".join(f"({regex})" for regex, _ in rules))
+        return combined, [negated for _, negated in rules]
+
+    def match(self, rel_path: str, is_dir: bool) -> bool | None:
+        """
+        Match a path against the rules
+
+        Args:
+            rel_path (str): Path relative to the root of the walk
+            is_dir (bool): Whether `rel_path` is a directory
+
+        Returns:
+            bool | None: True if the path is ignored, False if it is explicitly
+                re-included (negated pattern), None if no pattern matches
+        """
+        matcher = self._dir_matcher if is_dir else self._file_matcher
+        if matcher is None:
+            return None
+
+        rel_path = rel_path.replace(os.sep, "/")
+        if self.base_dir:
+            rel_path = rel_path.removeprefix(self.base_dir + "/")
+
+        combined, negated = matcher
+        match = combined.fullmatch(rel_path)
+        if match is None:
+            return None
+        return not negated[match.lastindex - 1]
+
+
+def translate_glob(pattern: str) -> str:
+    """
+    Translate a gitignore-style glob (without leading "!" and trailing "/") into
+    a regular expression without capturing groups
+    """
+    result = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        char = pattern[i]
+        i += 1
+        if char == "*":
+            if pattern[i : i + 1] == "*":
+                i += 1
+                if pattern[i : i + 1] == "/":
+                    i += 1
+                    result.append("(?:.*/)?")  # "**/": any number of dirs
+                else:
+                    result.append(".*")
+            else:
+                result.append("[^/]*")
+        elif char == "?":
+            result.append("[^/]")
+        elif char == "[":
+            end = pattern.find("]", i + 1 if pattern[i : i + 1] in "!^" else i)
+            if end == -1:
+                result.append(re.escape(char))
+                continue
+            chars = pattern[i:end]
+            if chars[:1] in ("!", "^"):
+                chars = "^" + chars[1:]
+            result.append("[" + chars.replace("\\", "\\\\") + "]")
+            i = end + 1
+        elif char == "\\" and i < n:
+            result.append(re.escape(pattern[i]))
+            i += 1
+        else:
+            result.append(re.escape(char))
+    return "".join(result)
+
+
+def is_ignored(rules: tuple[IgnoreRules, ...], rel_path: str, is_dir: bool) -> bool:
+    """
+    Check a path against a chain of ignore rules (outermost first). Rules from
+    deeper ignore files take precedence over those from upper levels
+
+    Args:
+        rules (tuple[IgnoreRules, ...]): Rules of the directories above the path
+        rel_path (str): Path relative to the root of the walk
+        is_dir (bool): Whether `rel_path` is a directory
+
+    Returns:
+        bool: True if the path should be ignored
+    """
+    for level in reversed(rules):
+        result = level.match(rel_path, is_dir)
+        if result is not None:
+            return result
+    return False
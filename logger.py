@@ -90,6 +90,17 @@ class Log:
             else:
                 log_func(message)
 
+    def is_enabled_for(self, level: str) -> bool:
+        """
+        Check if messages of the given level would be logged (useful to avoid
+        building expensive messages that would be discarded anyway)
+
+        Args:
+            level (str): Logging level name ("debug", "info", "warning",
+                "error", "critical")
+        """
+        return self.logger.isEnabledFor(logging.getLevelName(level.upper()))
+
     def debug(self, *args, **kwargs):
         """
         Log debug-level messages with optional header formatting
@@ -1,26 +1,177 @@
 import os
-import copy
+import re
+import sys
+import argparse
+import posixpath
 from pathlib import Path
-from typing import Generator
+from typing import IO, Generator, Iterable, Iterator, Mapping
+from contextlib import contextmanager
+from collections import ChainMap, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import yaml
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import Template, TemplateSyntaxError
 
 from config import Config
+from errors import (
+    ErrorReport,
+    MergeError,
+    OutputError,
+    TemplateError,
+    TemplaterError,
+    YamlFileError,
+)
+from ignore import IgnoreRules, is_ignored, translate_glob
+from manifest import DIR, FILE, DiscoveryManifest, scan_dir
+from merge import LayeredVars, Patch, apply_patch
+from templates import TemplateRegistry, compile_templates, create_environment
+from yaml_io import YamlBackend
 
 
 log = Config.log
-env = Environment(
-    loader=FileSystemLoader(Config.input_templates_dir),
-    autoescape=select_autoescape(disabled_extensions=("j2")),
-)
+env = create_environment()
+templates = TemplateRegistry(env)
+OUTPUT_BUFFER_SIZE = 1 << 16  # Rendered chunks are small, write them in blocks
+
+
+def main(argv: list[str] | None = None) -> int:
+    """
+    Render all (or selected) targets
+
+    A failing target (see `errors.TemplaterError`) does not stop the run, all
+    errors are reported at the end (the run stops early only after
+    Config.`max_errors` distinct errors)
 
+    Returns:
+        int: Exit status (1 if any target failed, else 0)
+    """
+    args = parse_args(argv)
+    if args.gc_cache:
+        gc_yaml_cache()
+        return 0
+    if args.compile_templates:
+        try:
+            count = compile_templates()
+        except TemplateSyntaxError as error:
+            location = f"{error.name}, line {error.lineno}"
+            log.error(f"Templates not compiled: {location}: {error.message}")
+            return 1
+        except OSError as error:
+            log.error(f"Templates not compiled: {error}")
+            return 1
+        log.info(f"Compiled {count} templates from {Config.input_templates_dir}")
+        if not Config.compiled_templates:
+            log.warning("Compiled templates are not used (see `compiled_templates`)")
+        return 0
 
-def main():
     log.info(f"Start working on YAML-files in {Config.input_data_dir}")
-    for yaml_path in find_target_yaml_files(Config.input_data_dir):
-        generate_and_save(yaml_path)
+    log.info(f"YAML backend: {YamlBackend.name} ({YamlBackend.profile} profile)")
+    manifest = open_discovery_manifest(rescan=args.rescan)
+    if args.targets:
+        targets = select_target_yaml_files(
+            args.targets,
+            manifest,
+            workers=Config.discovery_workers,
+        )
+    else:
+        targets = find_target_yaml_files(
+            Config.input_data_dir,
+            manifest,
+            workers=Config.discovery_workers,
+        )
+    targets = prefetch_targets(targets, depth=Config.prefetch_depth)
+    report = ErrorReport(max_errors=Config.max_errors)
+    stopped = False
+    for relative_path, target_type in targets:
+        try:
+            generate_and_save(relative_path, target_type)
+        except TemplaterError as error:
+            log.error(f"Skipping {relative_path}: {error}")
+            if report.add(relative_path, error):
+                log.error(f"Stopping after {len(report.errors)} errors (max_errors)")
+                stopped = True
+                break
+
+    if manifest is not None:
+        # Keep listings of directories not visited while rendering a subset
+        manifest.save(keep_unvisited=bool(args.targets) or stopped)
+        log.info(
+            f"Discovery: {manifest.hits} directories reused from manifest, "
+            f"{manifest.misses} listed"
+        )
+    if YamlBackend.cache is not None:
+        cache = YamlBackend.cache
+        log.info(f"YAML cache: {cache.hits} hits, {cache.misses} misses")
+        if cache.bytes_written:
+            cache.update_size()  # Walks the cache only if over the size cap
+    if env.bytecode_cache is not None:
+        cache = env.bytecode_cache
+        log.info(f"Jinja bytecode cache: {cache.hits} hits, {cache.misses} misses")
+    if templates.usage:
+        log.info("Templates used:", *templates.usage_lines())
+    if report:
+        log.error(
+            f"{len(report.errors)} errors, {report.failed_targets} targets failed:",
+            *report.lines(),
+        )
+        return 1
     log.info("Program finished")
+    return 0
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """
+    Parse command line arguments
+
+    Args:
+        argv (list[str], optional): Arguments to parse (`sys.argv` by default)
+
+    Returns:
+        argparse.Namespace: Parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Render Jinja2 templates using a hierarchy of YAML files",
+    )
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        help=(
+            "render only targets matching these paths or globs (relative to "
+            "the input data directory), e.g. 'cisco_ios/router/nyc-*'"
+        ),
+    )
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="ignore the discovery manifest and walk the whole input directory",
+    )
+    parser.add_argument(
+        "--gc-cache",
+        action="store_true",
+        help="garbage-collect the parsed YAML cache and exit",
+    )
+    parser.add_argument(
+        "--compile-templates",
+        action="store_true",
+        help="compile all templates into Python modules (used by next runs) and exit",
+    )
+    return parser.parse_args(argv)
+
+
+def gc_yaml_cache():
+    """
+    Remove stale entries from the parsed YAML cache and shrink it to fit into
+    Config.`yaml_cache_max_mb`
+    """
+    cache = YamlBackend.cache
+    if cache is None:
+        log.warning("YAML cache is disabled (see `yaml_cache`)")
+        return
+    removed, size = cache.gc(full=True)
+    log.warning(
+        f"YAML cache {cache.cache_dir}: {removed} entries removed, "
+        f"{size / 2**20:.1f} MB left"
+    )
 
 
 def path_should_be_skipped(path: str) -> bool:
@@ -32,37 +183,356 @@ def path_should_be_skipped(path: str) -> bool:
     return path.startswith(Config.skip_prefix)
 
 
-def find_target_yaml_files(root_dir: str) -> Generator[str, None, None]:
+def find_target_yaml_files(
+    root_dir: str,
+    manifest: DiscoveryManifest | None = None,
+    workers: int = 1,
+    start_dir: str = "",
+) -> Generator[tuple[str, str], None, None]:
     """
     Recursively walks through the directory tree starting from the provided
-    `root_dir`, yielding paths to all `.yaml` (target) files except those named
-    as Config.`vars_filename`
+    `root_dir` (or its `start_dir` subdirectory), yielding all `.yaml` (target)
+    files except those named as Config.`vars_filename`
+
+    Directories and files starting with Config.`skip_prefix` or matching
+    patterns of Config.`ignore_filename` files (at any level, gitignore-style)
+    are pruned before descending, so skipped subtrees are never listed. File
+    types are taken from the `os.DirEntry` objects returned by `os.scandir` (no
+    extra `stat` calls)
+
+    With `workers` > 1 directories are listed concurrently on a thread pool
+    (useful when every `readdir` is a network round trip). Either way targets
+    are yielded in the same (sorted, depth-first) order
 
     Args:
         root_dir (str): Root (starting) directory to search for YAML files
+        manifest (DiscoveryManifest, optional): Manifest to reuse listings of
+            unchanged directories from (every directory is listed otherwise)
+        workers (int): Number of threads listing directories concurrently
+        start_dir (str): Subdirectory of `root_dir` to walk (whole `root_dir`
+            by default)
 
     Yields:
-        str: Full path to each YAML file (excluding `Config.vars_filename`
-            files)
+        tuple[str, str]: Path relative to `root_dir` and `target_type` (name of
+            the top-level directory) of each target YAML file
+    """
+    if start_dir:
+        target_type = get_target_type(start_dir)
+        rules = load_ancestor_ignore_rules(root_dir, start_dir)
+        start = (start_dir, target_type, rules)
+    else:
+        start = ("", None, ())
+
+    if workers > 1:
+        yield from find_target_yaml_files_concurrently(
+            root_dir, manifest, workers, start
+        )
+        return
+
+    # Stack of (relative directory path, target type, ignore rules) left to scan
+    stack = [start]
+    while stack:
+        targets, subdirs = scan_target_dir(root_dir, *stack.pop(), manifest)
+        yield from targets
+        # Reversed, so that subdirectories are scanned in the sorted order
+        stack.extend(reversed(subdirs))
+
+
+def find_target_yaml_files_concurrently(
+    root_dir: str,
+    manifest: DiscoveryManifest | None,
+    workers: int,
+    start: tuple = ("", None, ()),
+) -> Generator[tuple[str, str], None, None]:
+    """
+    Same as `find_target_yaml_files`, but every directory is listed by a
+    separate task on a thread pool of `workers` threads. A task submits tasks
+    for its subdirectories as soon as its own listing is done, so sibling
+    subtrees are scanned concurrently, while results are still consumed in the
+    deterministic depth-first order
+
+    Args:
+        root_dir (str): Root (starting) directory to search for YAML files
+        manifest (DiscoveryManifest, optional): Manifest to reuse listings from
+        workers (int): Maximum number of threads listing directories
+        start (tuple): Directory to start from as (relative path, target type,
+            ignore rules of its parent directories)
+
+    Yields:
+        tuple[str, str]: Relative path and `target_type` of each target YAML
+    """
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan")
+
+    def scan(rel_dir: str, target_type: str | None, rules: tuple[IgnoreRules, ...]):
+        targets, subdirs = scan_target_dir(
+            root_dir, rel_dir, target_type, rules, manifest
+        )
+        return targets, [executor.submit(scan, *subdir) for subdir in subdirs]
+
+    try:
+        stack = [executor.submit(scan, *start)]
+        while stack:
+            targets, subdir_futures = stack.pop().result()
+            yield from targets
+            stack.extend(reversed(subdir_futures))
+    finally:
+        # Do not keep scanning if the consumer stops early
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def scan_target_dir(
+    root_dir: str,
+    rel_dir: str,
+    target_type: str | None,
+    rules: tuple[IgnoreRules, ...] = (),
+    manifest: DiscoveryManifest | None = None,
+) -> tuple[list[tuple[str, str]], list[tuple]]:
+    """
+    List a single directory (using `manifest`, if given) and split its sorted
+    entries into target YAML files and subdirectories to descend into, skipping
+    everything that should not be processed
+
+    Args:
+        root_dir (str): Root directory of the walk
+        rel_dir (str): Directory to list (relative to `root_dir`)
+        target_type (str | None): Target type of `rel_dir` (None for root)
+        rules (tuple[IgnoreRules, ...]): Ignore rules of the parent directories
+        manifest (DiscoveryManifest, optional): Manifest to reuse listings from
+
+    Returns:
+        tuple: List of (relative path, target type) pairs of target YAML files
+            and list of (relative path, target type, ignore rules) tuples of
+            subdirectories
     """
-    for dirpath, _, filenames in os.walk(root_dir):
-        if path_should_be_skipped(os.path.basename(dirpath)):
-            # Ignore dirs starting with the configured `skip_prefix`
+    try:
+        if manifest is not None:
+            entries = manifest.list_dir(rel_dir)
+        else:
+            entries = scan_dir(os.path.join(root_dir, rel_dir))
+    except OSError as error:
+        # Unreadable directories are skipped (same as `os.walk` does)
+        log.warning(f"Skipping directory {os.path.join(root_dir, rel_dir)}: {error}")
+        return [], []
+
+    entries.sort()
+    if Config.ignore_filename and (Config.ignore_filename, FILE) in entries:
+        ignore_path = os.path.join(root_dir, rel_dir, Config.ignore_filename)
+        try:
+            dir_rules = IgnoreRules.from_file(ignore_path, rel_dir)
+        except OSError as error:
+            log.warning(f"Skipping {ignore_path}: {error}")
+        else:
+            if dir_rules:
+                rules = (*rules, dir_rules)
+
+    targets = []
+    subdirs = []
+    for name, kind in entries:
+        if path_should_be_skipped(name):
+            # Ignore dirs/files starting with the configured `skip_prefix`
             continue
-        for file in filenames:
-            if path_should_be_skipped(file):
-                # Ignore files starting with the configured `skip_prefix`
-                continue
-            if not file.endswith(".yaml"):
-                # Ignore non-yaml files
-                continue
-            if file == Config.vars_filename:
-                # Ignore `vars_filename` files
+        rel_path = os.path.join(rel_dir, name)
+        if rules and is_ignored(rules, rel_path, is_dir=kind == DIR):
+            # Ignore dirs/files matching Config.`ignore_filename` patterns
+            continue
+        if kind == DIR:
+            subdirs.append((rel_path, target_type or name, rules))
+            continue
+        if not name.endswith(".yaml"):
+            # Ignore non-yaml files
+            continue
+        if name == Config.vars_filename:
+            # Ignore `vars_filename` files
+            continue
+        if kind != FILE:
+            continue
+        targets.append((rel_path, target_type or name))
+    return targets, subdirs
+
+
+def load_ancestor_ignore_rules(root_dir: str, rel_dir: str) -> tuple[IgnoreRules, ...]:
+    """
+    Load ignore rules of all directories above `rel_dir` (starting from
+    `root_dir`), so that a walk started from `rel_dir` skips the same paths as a
+    walk started from `root_dir` would
+
+    Args:
+        root_dir (str): Root directory of the walk
+        rel_dir (str): Directory relative to `root_dir`
+
+    Returns:
+        tuple[IgnoreRules, ...]: Ignore rules (outermost first)
+    """
+    if not Config.ignore_filename:
+        return ()
+
+    rules = []
+    parts = rel_dir.replace("\\", "/").split("/")
+    for i in range(len(parts)):
+        ancestor = os.path.join(*parts[:i]) if i else ""
+        ignore_path = os.path.join(root_dir, ancestor, Config.ignore_filename)
+        if not os.path.isfile(ignore_path):
+            continue
+        try:
+            dir_rules = IgnoreRules.from_file(ignore_path, ancestor)
+        except OSError as error:
+            log.warning(f"Skipping {ignore_path}: {error}")
+            continue
+        if dir_rules:
+            rules.append(dir_rules)
+    return tuple(rules)
+
+
+def select_target_yaml_files(
+    patterns: list[str],
+    manifest: DiscoveryManifest | None = None,
+    workers: int = 1,
+) -> Generator[tuple[str, str], None, None]:
+    """
+    Yield only the targets selected by `patterns` (each target once, in the
+    order of the patterns)
+
+    A pattern is a path (relative to Config.`input_data_dir` or to the current
+    directory) or a glob (e.g. "cisco_ios/router/nyc-*"). It selects a target if
+    it matches the target's relative path (with or without the ".yaml"
+    extension) or any of its parent directories. Globs use the same syntax as
+    ignore files ("*" does not match "/", "**" matches any number of dirs)
+
+    An existing target file is yielded right away, without walking the tree
+    (even if it would be skipped by Config.`skip_prefix` or ignore files). For
+    directories and globs only the subtree below the longest non-glob prefix is
+    walked
+
+    Args:
+        patterns (list[str]): Paths and/or globs selecting targets
+        manifest (DiscoveryManifest, optional): Manifest to reuse listings from
+        workers (int): Number of threads listing directories concurrently
+
+    Yields:
+        tuple[str, str]: Relative path and `target_type` of each target YAML
+    """
+    root_dir = Config.input_data_dir
+
+    def is_dir(rel_dir: str) -> bool:
+        return os.path.isdir(os.path.join(root_dir, rel_dir))
+
+    seen = set()
+    for pattern in patterns:
+        rel_pattern = normalize_target_pattern(pattern)
+        if rel_pattern is None:
+            log.warning(f"Skipping {pattern!r}: outside of {root_dir}")
+            continue
+        full_path = os.path.join(root_dir, rel_pattern)
+
+        if is_target_path(rel_pattern) and os.path.isfile(full_path):
+            # Exact path to a target: no need to walk anything
+            targets = [(rel_pattern, get_target_type(rel_pattern))]
+        elif not rel_pattern:
+            targets = find_target_yaml_files(root_dir, manifest, workers)
+        else:
+            parts = rel_pattern.split("/")
+            literal_parts = []
+            for part in parts:
+                if has_glob_magic(part):
+                    break
+                literal_parts.append(part)
+            start_dir = "/".join(literal_parts)
+            if len(literal_parts) == len(parts) and not is_dir(start_dir):
+                # The last part may be a target without ".yaml"
+                start_dir = os.path.dirname(start_dir)
+
+            regex = re.compile(translate_glob(rel_pattern) + r"(?:\.yaml|/.*)?")
+            if start_dir and not is_dir(start_dir):
+                targets = []  # Nothing to walk
+            else:
+                targets = (
+                    target
+                    for target in find_target_yaml_files(
+                        root_dir, manifest, workers, start_dir=start_dir
+                    )
+                    if regex.fullmatch(target[0].replace(os.sep, "/"))
+                )
+
+        matched = False
+        for target in targets:
+            matched = True
+            if target[0] in seen:
                 continue
-            yield os.path.join(dirpath, file)
+            seen.add(target[0])
+            yield target
+        if not matched:
+            log.warning(f"No targets match {pattern!r}")
+
 
+def normalize_target_pattern(pattern: str) -> str | None:
+    """
+    Convert a path/glob given relative to the current directory (or absolute)
+    into one relative to Config.`input_data_dir` (with "/" separators). Relative
+    patterns outside of Config.`input_data_dir` are considered to be relative
+    to it
 
-def generate_and_save(yaml_path: str):
+    Returns:
+        str | None: Relative pattern, None if it points outside of
+            Config.`input_data_dir` (e.g. "/tmp/x.yaml", "../input_data")
+    """
+    input_data_dir = os.path.abspath(Config.input_data_dir)
+    rel_pattern = os.path.relpath(os.path.abspath(pattern), input_data_dir)
+    if rel_pattern == ".." or rel_pattern.startswith(".." + os.sep):
+        rel_pattern = os.path.normpath(pattern)
+    rel_pattern = rel_pattern.replace("\\", "/")
+    if os.path.isabs(rel_pattern) or rel_pattern.split("/")[0] == "..":
+        return None
+    return "" if rel_pattern == "." else rel_pattern
+
+
+def is_target_path(rel_path: str) -> bool:
+    """
+    Check if `rel_path` (without glob special characters) may be a target YAML
+    """
+    filename = os.path.basename(rel_path)
+    return (
+        not has_glob_magic(rel_path)
+        and filename.endswith(".yaml")
+        and filename != Config.vars_filename
+    )
+
+
+def has_glob_magic(pattern: str) -> bool:
+    """
+    Check if the `pattern` contains glob special characters
+    """
+    return any(char in pattern for char in "*?[")
+
+
+def open_discovery_manifest(rescan: bool = False) -> DiscoveryManifest | None:
+    """
+    Create a DiscoveryManifest for Config.`input_data_dir` (if enabled by
+    Config.`discovery_manifest`), loading cached listings unless `rescan` is set
+
+    Args:
+        rescan (bool): Ignore cached listings (full walk), but save new ones
+
+    Returns:
+        DiscoveryManifest: Manifest to pass to `find_target_yaml_files` or None
+    """
+    if not Config.discovery_manifest:
+        return None
+
+    manifest_path = os.path.join(Config.cache_dir, "discovery_manifest.json")
+    manifest = DiscoveryManifest(manifest_path, Config.input_data_dir)
+    if rescan:
+        log.info("Discovery manifest ignored (full rescan requested)")
+        return manifest
+
+    error = manifest.load()
+    if error is None:
+        log.debug(f"Loaded discovery manifest {manifest_path}")
+    else:
+        log.debug(f"Not using discovery manifest {manifest_path}: {error}")
+    return manifest
+
+
+def generate_and_save(relative_path: str, target_type: str):
     """
     Generate and save a text file based on the provided path the target YAML
 
@@ -71,41 +541,137 @@ def generate_and_save(yaml_path: str):
         immediately inside Config.`input_data_dir`)
     - Merges it with inherited variables from all applicable
         Config.`vars_filename` files
-    - Selects the appropriate template ("base.j2") inside the `target_type`
-        directory
-    - Renders the output text
+    - Selects the template (see `select_template`), "base.j2" inside the
+        `target_type` directory by default
+    - Renders the output text, streaming it to the output file
     - Saves the outputs (text file and optinally final merged YAML)
 
     Args:
-        yaml_path (str): Full path to the target YAML file
-    """
+        relative_path (str): Path to the target YAML file (relative to the
+            Config.`input_data_dir`)
+        target_type (str): Top-level directory name of the target
 
-    # Compute path relative to the `input_data_dir`
-    relative_path = os.path.relpath(yaml_path, Config.input_data_dir)
+    Raises:
+        TemplaterError: If the target can not be generated
+    """
 
     # Merge all inherited and target-specific variables
-    merged_vars = load_vars_hierarchy(relative_path)
-    if merged_vars is None:
-        return
+    merged_vars = load_vars_hierarchy(relative_path, target_type)
 
     # Select template based on the top-level target type (e.g. "cisco_ios")
-    template_path = f"{merged_vars['target_type']}/base.j2"
+    # or "template_dir" and "template_name" variables
+    template_path = select_template(merged_vars)
+    template = templates.get(template_path)
+
+    # Materialize lazily merged variables only if they are saved
+    if Config.save_merged_yamls and not isinstance(merged_vars, dict):
+        merged_vars = dict(merged_vars)
+
+    # Render the final text file while saving it (and optionally merged YAML)
+    rendered_chunks = render_template(template, merged_vars)
+    try:
+        save_output_files(relative_path, rendered_chunks, merged_vars)
+    except OSError as error:
+        raise OutputError(error.strerror or str(error), error.filename) from error
+    templates.record_use(template_path)
+
+
+def select_template(merged_vars: Mapping) -> str:
+    """
+    Return the path of the template (relative to Config.`input_templates_dir`)
+    selected by merged variables:
+    - "template_name" (default "base"): name of the template, ".j2" is
+        appended unless it is already there, may include subdirectories
+        (e.g. "router/base", "firewall/edge")
+    - "template_dir" (default `target_type`): directory of the template, "."
+        for the root of Config.`input_templates_dir`
+
+    Args:
+        merged_vars (Mapping): Merged variables of the target
+
+    Returns:
+        str: Template path, e.g. "cisco_ios/router/base.j2"
+
+    Raises:
+        TemplateError: If "template_name" or "template_dir" is not a string
+    """
+    template_name = merged_vars.get("template_name")
+    template_dir = merged_vars.get("template_dir")
+    if template_name is None:
+        template_name = "base"
+    if template_dir is None:
+        template_dir = merged_vars["target_type"]
+    for key, val in (("template_name", template_name), ("template_dir", template_dir)):
+        if not isinstance(val, str):
+            text = f"Variable '{key}' must be a string, not {type(val).__name__}"
+            raise TemplateError(text)
+    if not template_name.endswith(".j2"):
+        template_name += ".j2"
+    return posixpath.normpath(posixpath.join(template_dir, template_name))
+
+
+def render_template(template: Template, variables: Mapping) -> Iterator[str]:
+    """
+    Render `template` with `variables` chunk by chunk (same as
+    `template.generate`, but any mapping, e.g. lazily merged
+    `merge.LayeredVars`, is used as is instead of being copied into a dict, so
+    only the variables used are resolved)
+
+    Args:
+        template (Template): Loaded template
+        variables (Mapping): Template variables
+
+    Yields:
+        str: Chunks of the rendered text
+
+    Raises:
+        TemplaterError: If the template can not be rendered
+    """
+    # Writes (and copies, e.g. by Jinja tracebacks) go to the first (empty) map
+    variables = ChainMap({}, variables, template.globals)
+    context = template.new_context(variables, shared=True)
     try:
-        template = env.get_template(template_path)
+        try:
+            yield from template.root_render_func(context)
+        except Exception:
+            env.handle_exception()  # Re-raises with template line numbers
+    except TemplaterError:
+        raise  # E.g. a merge error of lazily merged variables
     except Exception as error:
-        log.error(f"Error while loading template '{template_path}': {error}")
-        return
+        text = f"Error while rendering template: {type(error).__name__}: {error}"
+        raise TemplateError(text, template.name) from error
+
 
-    # Render the final text file
-    rendered_text = template.render(merged_vars)
+@contextmanager
+def open_atomic(path: str, mode: str = "w") -> Generator[IO, None, None]:
+    """
+    Open a temporary file next to `path` for writing, replacing `path` with it
+    once the block succeeds (otherwise it is removed), so readers never see a
+    partially written file
+
+    Args:
+        path (str): Destination file
+        mode (str): File mode ("w" or "wb")
 
-    # Save rendered text file (and optionally merged YAML)
-    save_output_files(relative_path, rendered_text, merged_vars)
+    Yields:
+        IO: Temporary file (buffered by OUTPUT_BUFFER_SIZE bytes)
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, mode, buffering=OUTPUT_BUFFER_SIZE) as file:
+            yield file
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
 
 
 def save_output_files(
     relative_path: str,
-    rendered_text: str,
+    rendered_chunks: Iterable[str],
     merged_vars: dict,
 ):
     """
@@ -113,7 +679,9 @@ def save_output_files(
 
     Behavior:
     - The rendered text file is always saved (with a configured extension) in
-        the `output_data_dir`, preserving the relative structure
+        the `output_data_dir`, preserving the relative structure. It is
+        written chunk by chunk (not kept in memory as a whole) to a temporary
+        file, which then replaces the previous version (see `open_atomic`)
     - If Config.`save_merged_yamls` is True, the merged YAML variables are saved
         as well:
         * If Config.`merged_yamls_path` is None, then YAML files are saved in a
@@ -127,8 +695,9 @@ def save_output_files(
         relative_path (str): Relative path to the target YAML file (relative to
             the Config.`input_data_dir`)
         merged_vars (dict): Fully merged variables dictionary to save as YAML
-        rendered_text (str): Rendered text to be saved as a file with
-            Config.`output_ext` extension
+        rendered_chunks (Iterable[str]): Rendered text (e.g. chunks generated
+            by `render_template`) to be saved as a file with Config.`output_ext`
+            extension
     """
     # Prepare the target filename
     target_filename = os.path.splitext(relative_path)[0] + Config.output_ext
@@ -136,9 +705,9 @@ def save_output_files(
     os.makedirs(os.path.dirname(target_path), exist_ok=True)
 
     # Save the rendered file
-    with open(target_path, "w") as file:
-        file.write(rendered_text)
-        log.info(f"Created: {target_path}")
+    with open_atomic(target_path) as file:
+        file.writelines(rendered_chunks)
+    log.info(f"Created: {target_path}")
 
     # Save merged YAML variables if enabled
     if Config.save_merged_yamls:
@@ -150,251 +719,308 @@ def save_output_files(
             merged_yaml_path = os.path.join(Config.output_data_dir, "yamls", yaml_name)
 
         os.makedirs(os.path.dirname(merged_yaml_path), exist_ok=True)
-        with open(merged_yaml_path, "w") as yaml_file:
-            yaml.dump(merged_vars, yaml_file)
+        try:
+            with open_atomic(merged_yaml_path) as yaml_file:
+                YamlBackend.dump(merged_vars, yaml_file)
+        except RecursionError as error:
+            text = "Merged variables are nested too deep to be saved as YAML"
+            raise OutputError(text, merged_yaml_path) from error
         log.info(f"Created: {merged_yaml_path}")
 
 
-def merge_dicts_deep(base: dict, override: dict) -> dict:
+def get_target_type(yaml_path: str) -> str:
     """
-    Recursively merges two dictionaries with support for advanced override logic
-
-    The `override` dictionary can:
-    - Add or replace values at any depth
-    - Remove entire keys using `key: false` or `key__remove: true`
-    - Remove specific list items using `key__remove: [items]`
-    - Append items to lists using `key__append: [items]`
-    - Delete nested keys using `__delete_keys__` and dot notation
-
-    This function returns a new merged dictionary without modifying the original
+    Extracts the top-level directory name from a relative YAML path to represent
+    the target type (e.g., 'cisco_ios', 'juniper', 'whatever')
 
     Args:
-        base (dict): The base dictionary to be merged into
-        override (dict): The dictionary with overrides or modifications
+        yaml_path (str): Relative path to the target YAML file (relative from
+            the root of Config.`input_data_dir`)
 
     Returns:
-        dict: A new dictionary representing the merged result
-    """
-    if not isinstance(base, dict) or not isinstance(override, dict):
-        # Non-dict types are fully replaced
-        return copy.deepcopy(override)
-
-    result = copy.deepcopy(base)
-
-    # Delete nested keys specified by '__delete_keys__'
-    delete_keys = override.get("__delete_keys__", [])
-    if delete_keys:
-        delete_keys_with_dot_notation(result, delete_keys)
-
-    # Handle keys with '__remove' and '__append' suffixes
-    handle_remove_keys(result, override)
-    handle_append_keys(result, override)
-
-    # Remove keys with value False
-    remove_false_values(result, override)
-
-    # Merge other keys recursively or replace
-    for key, val in override.items():
-        if (
-            key == "__delete_keys__"
-            or key.endswith("__remove")
-            or key.endswith("__append")
-            or val is False
-        ):
-            # These have already been processed above
-            continue
-
-        base_val = result.get(key)
+        str: Top-level directory name representing the taget type
+    """
+    target_type = yaml_path.replace("\\", "/").split("/")[0]
+    return target_type
 
-        if isinstance(base_val, dict) and isinstance(val, dict):
-            # Recursive merge for nested dicts
-            result[key] = merge_dicts_deep(base_val, val)
-        elif isinstance(base_val, list) and isinstance(val, list):
-            # Replace lists entirely
-            result[key] = copy.deepcopy(val)
-        else:
-            # Override scalar or non-dict types
-            result[key] = copy.deepcopy(val)
 
-    return result
+# Merged variables of every directory processed so far, keyed by directory path
+# relative to Config.`input_data_dir` ("" for the root). Directories with an
+# invalid Config.`vars_filename` file along their path map to the error
+dir_vars_cache: dict[str, Mapping | TemplaterError] = {}
 
 
-def delete_keys_with_dot_notation(target: dict, keys: list):
+def load_vars_hierarchy(yaml_path: str, target_type: str | None = None) -> Mapping:
     """
-    Delete nested keys in `target` dictionary using dot-separated key paths
+    Loads and deeply merges all Config.`vars_filename` files found along the
+    directory hierarchy leading to a target YAML file, including the target file
+    itself at the end
+
+    Supports advanced override features via `merge_dicts_deep` (every file is
+    compiled into a `Patch` once, see `read_yaml_file`)
+
+    Merged variables of every directory are computed once (see `load_dir_vars`)
+    and reused for all targets below it, so per target only the target file
+    itself is parsed and merged
+
+    Example hierarchy:
+    - `input_data_dir`/vars.yaml (global)
+    - `input_data_dir`/cisco_ios/vars.yaml (vendor-specific)
+    - `input_data_dir`/cisco_ios/router/vars.yaml (role-specific)
+    - `input_data_dir`/cisco_ios/router/new_york.yaml (target-specific)
 
     Args:
-        target (dict): The dictionary to delete keys from
-        keys (list): List of dotted key strings, e.g. ['bgp.neighbors.10.1.1.1']
-    """
-    for dotted_key in keys:
-        parts = dotted_key.split(".")
-        cur = target
-        for i, part in enumerate(parts):
-            if isinstance(cur, dict) and part in cur:
-                if i == len(parts) - 1:
-                    del cur[part]
-                else:
-                    cur = cur[part]
-            else:
-                break  # Key path does not exist; nothing to delete
+        yaml_path (str): Relative path (starting from Config.`input_data_dir`)
+            to the target YAML
+        target_type (str, optional): Target type, if already known (otherwise
+            derived from `yaml_path` using `get_target_type`)
 
+    Returns:
+        Mapping: Fully merged variable dictionary (or a lazily merged
+            `merge.LayeredVars` view, see Config.`lazy_vars`)
 
-def handle_remove_keys(target: dict, override: dict):
+    Raises:
+        TemplaterError: If any of the files can not be loaded or merged
     """
-    Process keys ending with '__remove' in the override dictionary
+    target_yaml_full_path = os.path.join(Config.input_data_dir, yaml_path)
+    log.debug(target_yaml_full_path, h=1)
 
-    - If override[key] is True, remove the whole base key
-    - If override[key] is a list and base key is a list, remove listed items from base list
+    # Merged variables of all Config.`vars_filename` files above the target
+    rel_dir = os.path.dirname(yaml_path).replace("\\", "/")
+    dir_vars = load_dir_vars(rel_dir)
 
-    Args:
-        target (dict): The base dictionary to modify
-        override (dict): The override dictionary containing removal instructions
-    """
-    for key in list(override.keys()):
-        if not key.endswith("__remove"):
-            continue
+    # Merge the target YAML file itself at the end
+    data = read_yaml_file(target_yaml_full_path)
+    if data is None:
+        data = Patch.compile({})
+    merged_data = merge_layer(dir_vars, data, target_yaml_full_path)
 
-        base_key = key.removesuffix("__remove")
-        val = override[key]
+    # Add "target_type" key
+    if target_type is None:
+        target_type = get_target_type(yaml_path)
+    merged_data["target_type"] = target_type
+    log.debug(f"target_type -> {merged_data['target_type']}", h=2)
 
-        if val is True:
-            target.pop(base_key, None)
-        elif isinstance(val, list) and isinstance(target.get(base_key), list):
-            target[base_key] = [item for item in target[base_key] if item not in val]
+    # Set configured variable (if any) from filename
+    if Config.filename_variable is not None:
+        result = set_var_from_filename(merged_data, yaml_path, Config.filename_variable)
+        if result:
+            log.debug(result, h=2)
+
+    log.info(h=3)
+    log.info(f"Processed: {target_yaml_full_path}")
+
+    return merged_data
 
 
-def handle_append_keys(target: dict, override: dict):
+def load_dir_vars(rel_dir: str) -> Mapping:
     """
-    Process keys ending with '__append' in the override dictionary
+    Return merged variables of all Config.`vars_filename` files from the root of
+    Config.`input_data_dir` down to `rel_dir` (inclusive)
 
-    - If base key is a list, append the new items
-    - If base key is missing, create it as a new list
-    - If base key exists but is not a list, show text and exit
+    Results are memoized in `dir_vars_cache` for every directory (including
+    ones without Config.`vars_filename`), so each file is parsed and merged
+    only once per run. The returned dictionary is shared and must not be
+    modified
 
     Args:
-        target (dict): The base dictionary to modify
-        override (dict): The override dictionary containing append instructions
-    """
-    for key in list(override.keys()):
-        if not key.endswith("__append"):
-            continue
+        rel_dir (str): Directory relative to Config.`input_data_dir` ("" for
+            the root, "/" as a separator)
 
-        base_key = key.removesuffix("__append")
-        val = override[key]
+    Returns:
+        Mapping: Merged variables (see `merge_layer`)
 
-        if not isinstance(val, list):
-            text = f"Error occured while parsing {key!r} with value {val!r}\n"
-            text += f"Only lists can be appended, not {type(val).__name__}"
-            log.critical(text)
-            exit()
+    Raises:
+        TemplaterError: If any of the files could not be loaded or merged (the
+            same error, cloned, for all directories below it)
+    """
+    if rel_dir in dir_vars_cache:
+        result = dir_vars_cache[rel_dir]
+        if isinstance(result, TemplaterError):
+            raise result.clone()
+        return result
 
-        if base_key not in target:
-            target[base_key] = val.copy()
-        elif isinstance(target[base_key], list):
-            target[base_key].extend(val)
+    try:
+        if rel_dir:
+            parent_vars = load_dir_vars(os.path.dirname(rel_dir))
         else:
-            text = f"Error occured while parsing {key!r} with value {val!r}\n"
-            text += f"Can append to lists only, not {type(target[base_key]).__name__}"
-            log.critical(text)
-            exit()
+            parent_vars = {}
+
+        path = os.path.join(Config.input_data_dir, rel_dir, Config.vars_filename)
+        data = read_yaml_file(path)
+        if data is None:
+            result = parent_vars
+        else:
+            result = merge_layer(parent_vars, data, path)
+    except TemplaterError as error:
+        dir_vars_cache[rel_dir] = error.clone()
+        raise
+
+    dir_vars_cache[rel_dir] = result
+    return result
 
 
-def remove_false_values(target: dict, override: dict):
+def read_yaml_file(path: str) -> Patch | None:
     """
-    Remove keys from `target` where override[key] is exactly False
+    Read, parse and compile a YAML file into a `Patch` (taking the result
+    prefetched by `prefetch_targets`, if any)
+
+    Compiled patches are stored in the persistent YAML cache (if enabled), so
+    unchanged files are neither parsed nor compiled again on the next run
 
     Args:
-        target (dict): The base dictionary to modify
-        override (dict): The override dictionary
+        path (str): Path to the YAML file
+
+    Returns:
+        Patch: Compiled data (of an empty dict for an empty file) or None if the
+            file does not exist
+
+    Raises:
+        YamlFileError: If the file can not be read, parsed or compiled
+        MergeError: If the file contains an invalid merge instruction
     """
-    for key, val in override.items():
-        if val is False:
-            target.pop(key, None)
+    future = prefetched_yaml_files.pop(path, None)
+    try:
+        if future is not None:
+            return future.result()
+        return parse_yaml_file(path)
+    except yaml.YAMLError as error:
+        raise YamlFileError(f"YAML {type(error).__name__}: {error}", path) from error
+    except OSError as error:
+        raise YamlFileError(error.strerror or str(error), path) from error
+    except TemplaterError as error:
+        error.path = path  # E.g. an invalid merge instruction found by Patch.compile
+        raise
+    except Exception as error:  # Unexpected data the compiler fails on
+        text = f"Can not compile: {type(error).__name__}: {error}"
+        raise YamlFileError(text, path) from error
+
+
+def parse_yaml_file(path: str) -> Patch | None:
+    """
+    Same as `read_yaml_file`, but always reads the file (safe to call from any
+    thread)
+    """
+    try:
+        patch = YamlBackend.load_file(path, YamlBackend.DataLoader, compiler=Patch)
+    except FileNotFoundError:
+        return None
+    if not patch.data:
+        return Patch.compile({})
+    return patch
 
 
-def get_target_type(yaml_path: str) -> str:
+# Parsed YAML files (by full path) being read ahead by `prefetch_targets`
+prefetched_yaml_files: dict[str, Future] = {}
+
+
+def prefetch_targets(
+    targets: Iterable[tuple[str, str]],
+    depth: int,
+) -> Generator[tuple[str, str], None, None]:
     """
-    Extracts the top-level directory name from a relative YAML path to represent
-    the target type (e.g., 'cisco_ios', 'juniper', 'whatever')
+    Pass `targets` through, reading and parsing YAML files of the next `depth`
+    targets (and all their Config.`vars_filename` files not merged yet) on a
+    thread pool, while the current target is being processed
+
+    Results are stored in `prefetched_yaml_files` and taken from there by
+    `read_yaml_file` (in the main thread)
 
     Args:
-        yaml_path (str): Relative path to the target YAML file (relative from
-            the root of Config.`input_data_dir`)
+        targets (Iterable): (relative path, target type) pairs
+        depth (int): Number of targets to read ahead (0 disables prefetching)
 
-    Returns:
-        str: Top-level directory name representing the taget type
+    Yields:
+        tuple[str, str]: The same (relative path, target type) pairs
     """
-    target_type = yaml_path.replace("\\", "/").split("/")[0]
-    return target_type
+    if depth <= 0:
+        yield from targets
+        return
 
+    workers = min(depth, (os.cpu_count() or 1) + 4)
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
 
-def load_vars_hierarchy(yaml_path: str) -> dict | None:
+    def prefetch(path: str):
+        if path not in prefetched_yaml_files:
+            prefetched_yaml_files[path] = executor.submit(parse_yaml_file, path)
+
+    queue = deque()
+    try:
+        for target in targets:
+            rel_dir = os.path.dirname(target[0]).replace("\\", "/")
+            parts = rel_dir.split("/") if rel_dir else []
+            for i in range(len(parts) + 1):
+                dir_path = "/".join(parts[:i])
+                if dir_path not in dir_vars_cache:
+                    prefetch(
+                        os.path.join(
+                            Config.input_data_dir, dir_path, Config.vars_filename
+                        )
+                    )
+            prefetch(os.path.join(Config.input_data_dir, target[0]))
+
+            queue.append(target)
+            if len(queue) > depth:
+                yield queue.popleft()
+        while queue:
+            yield queue.popleft()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        prefetched_yaml_files.clear()
+
+
+def merge_layer(merged_data: Mapping, patch: Patch, path: str) -> Mapping:
     """
-    Loads and deeply merges all Config.`vars_filename` files found along the
-    directory hierarchy leading to a target YAML file, including the target file
-    itself at the end
+    Apply `patch` loaded from `path` on top of `merged_data` (logging both and
+    the result at debug level)
 
-    Supports advanced override features via `deep_merge_custom`
+    `patch` must be freshly loaded (not referenced anywhere else), so its data
+    is moved into the result without copying. `merged_data` may be shared
+    (cached) and is not modified
 
-    Example hierarchy:
-    - `input_data_dir`/vars.yaml (global)
-    - `input_data_dir`/cisco_ios/vars.yaml (vendor-specific)
-    - `input_data_dir`/cisco_ios/router/vars.yaml (role-specific)
-    - `input_data_dir`/cisco_ios/router/new_york.yaml (target-specific)
-
-    Args:
-        yaml_path (str): Relative path (starting from Config.`input_data_dir`)
-            to the target YAML
+    If Config.`lazy_vars` is set, a `merge.LayeredVars` view is returned
+    instead, merging only the keys actually used (when they are used)
 
     Returns:
-        dict: Fully merged variable dictionary
-    """
-    # Build a list of all YAML files to merge
-    yaml_files = []
-    path_parts = os.path.dirname(yaml_path).replace("\\", "/").split("/")
-    for i in range(len(path_parts) + 1):
-        # Build path to Config.`vars_filename` at this level
-        partial_path = os.path.join(*path_parts[:i], Config.vars_filename)
-        full_path = os.path.join(Config.input_data_dir, partial_path)
-        yaml_files.append(full_path)
-
-    # Add the target YAML file itself at the end
-    target_yaml_full_path = os.path.join(Config.input_data_dir, yaml_path)
-    yaml_files.append(target_yaml_full_path)
+        Mapping: A new merged dictionary (or a LayeredVars view)
 
-    # Merge all YAML files in order
-    log.debug(target_yaml_full_path, h=1)
-    merged_data = {}
-    for path in yaml_files:
-        if not os.path.exists(path):
-            continue
-        with open(path, "r") as file:
-            try:
-                data = yaml.safe_load(file) or {}
-            except yaml.scanner.ScannerError as error:
-                log.error(f"YAML ScannerError: {error}")
-                return
-            log.debug(path, h=2)
-            log.debug("old data", yaml.dump(merged_data), h=3)
-            log.debug("new data", yaml.dump(data), h=3)
-            merged_data = merge_dicts_deep(merged_data, data)
-            log.debug("merged data", yaml.dump(merged_data), h=3)
+    Raises:
+        TemplaterError: If the file is not a mapping or can not be merged
+    """
+    if not isinstance(patch.data, dict):
+        text = f"Top level must be a mapping, not {type(patch.data).__name__}"
+        raise YamlFileError(text, path)
 
-    # Add "target_type" key
-    merged_data["target_type"] = get_target_type(yaml_path)
-    log.debug(f"target_type -> {merged_data['target_type']}", h=2)
+    debug = log.is_enabled_for("debug")
+    if Config.lazy_vars:
+        if debug:
+            log.debug(path, h=2)
+            log.debug("new data (merged lazily)", dump_for_log(patch.data), h=3)
+        return LayeredVars(merged_data, patch, path)
 
-    # Set configured variable (if any) from filename
-    if Config.filename_variable is not None:
-        result = set_var_from_filename(merged_data, yaml_path, Config.filename_variable)
-        if result:
-            log.debug(result, h=2)
+    if debug:
+        log.debug(path, h=2)
+        log.debug("old data", dump_for_log(merged_data), h=3)
+        log.debug("new data", dump_for_log(patch.data), h=3)
+    try:
+        merged_data = apply_patch(merged_data, patch, own_override=True)
+    except MergeError as error:
+        error.path = path
+        raise
+    if debug:
+        log.debug("merged data", dump_for_log(merged_data), h=3)
+    return merged_data
 
-    log.info(h=3)
-    log.info(f"Processed: {target_yaml_full_path}")
 
-    return merged_data
+def dump_for_log(data) -> str:
+    """
+    Serialize `data` as YAML for debug logs (a placeholder text if it is nested
+    too deep for the dumper)
+    """
+    try:
+        return YamlBackend.dump(data)
+    except RecursionError:
+        return "(nested too deep to be dumped)\n"
 
 
 def set_var_from_filename(data: dict, yaml_path: str, variable: str) -> str | None:
@@ -402,7 +1028,9 @@ def set_var_from_filename(data: dict, yaml_path: str, variable: str) -> str | No
     Set a variable (if it does not already exist) in a YAML dictionary from the
     filename
 
-    Nested keys are created automatically if they do not exist
+    Nested keys are created automatically if they do not exist. Nested
+    dictionaries along the path are copied rather than modified (they may be
+    shared with other merged results, see `merge_dicts_deep`)
 
     Args:
         data (dict): Loaded YAML data
@@ -417,7 +1045,7 @@ def set_var_from_filename(data: dict, yaml_path: str, variable: str) -> str | No
 
     def set_if_missing(data: dict, path: list[str], value: str):
         """
-        Recursively set a value if missing in a nested dictionary
+        Set a value if missing in a nested dictionary
 
         Args:
             data (dict): The dictionary to update
@@ -429,18 +1057,25 @@ def set_var_from_filename(data: dict, yaml_path: str, variable: str) -> str | No
             bool: True if a new variable was set, False if it already existed or
                 could not be set (e.g., a non-dict value blocks the path)
         """
-        key = path[0]
-        if len(path) == 1:
-            if key not in data:
-                data[key] = value
-                return True
-            return False
-        else:
-            subdict = data.setdefault(key, {})
+        # Walk down first: nothing is modified unless the value is set
+        parents = [data]
+        for key in path[:-1]:
+            subdict = parents[-1].get(key, {})
             if not isinstance(subdict, dict):
                 # If a non-dict value exists, don't overwrite it
                 return False
-            return set_if_missing(subdict, path[1:], value)
+            parents.append(subdict)
+        if path[-1] in parents[-1]:
+            return False
+
+        # Set the value in copies of the nested dicts (bottom-up), since they
+        # may be shared with cached data
+        node = value
+        for depth in range(len(path) - 1, -1, -1):
+            parent = dict(parents[depth]) if depth else data
+            parent[path[depth]] = node
+            node = parent
+        return True
 
     filename_stem = Path(yaml_path).stem
     if set_if_missing(data, variable.split("."), filename_stem):
@@ -449,4 +1084,4 @@ def set_var_from_filename(data: dict, yaml_path: str, variable: str) -> str | No
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
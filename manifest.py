@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import threading
+
+
+# Directory entry kinds stored in the manifest
+DIR = "d"
+FILE = "f"
+OTHER = "o"
+
+
+def scan_dir(path: str) -> list[tuple[str, str]]:
+    """
+    List a directory using `os.scandir`, classifying every entry by the type
+    information of its `os.DirEntry` (no extra `stat` calls on most platforms)
+
+    Symlinks to directories are reported as OTHER, so they are never descended
+    into (same as `os.walk` with its default `followlinks=False`)
+
+    Args:
+        path (str): Directory to list
+
+    Returns:
+        list[tuple[str, str]]: (name, kind) pairs, kind being DIR, FILE or OTHER
+    """
+    result = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                kind = DIR
+            elif entry.is_file():
+                kind = FILE
+            else:
+                kind = OTHER
+            result.append((entry.name, kind))
+    return result
+
+
+class DiscoveryManifest:
+    """
+    On-disk cache of directory listings used by target discovery
+
+    Every listed directory is stored together with its `st_mtime_ns` and
+    `st_ino`. On the next run a directory is listed again only if one of them
+    has changed; otherwise its cached listing is reused, replacing a `readdir`
+    (expensive on network filesystems) with a single `stat`
+
+    Listings of directories modified less than `racy_window_ns` before the scan
+    are not reused, since further changes within the same mtime tick would go
+    unnoticed
+
+    `list_dir` may be called from several threads at once
+
+    Example:
+        >>> manifest = DiscoveryManifest("output_data/.cache/manifest.json", root)
+        >>> manifest.load()
+        >>> entries = manifest.list_dir("cisco_ios/router")
+        >>> manifest.save()
+    """
+
+    version = 1
+    racy_window_ns = 2 * 10**9
+
+    def __init__(self, path: str, root_dir: str):
+        self.path = path
+        self.root_dir = os.path.abspath(root_dir)
+        self.cached: dict[str, dict] = {}
+        self.visited: dict[str, dict] = {}
+        self.hits = 0
+        self.misses = 0
+        self.started_ns = time.time_ns()
+        self._lock = threading.Lock()
+
+    def load(self) -> str | None:
+        """
+        Load cached listings from `self.path` (if present and compatible)
+
+        Returns:
+            str: Reason why the manifest was not loaded, None on success
+        """
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return "Not found"
+        except (OSError, ValueError) as error:
+            return str(error)
+
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            return "Unsupported version"
+        if data.get("root") != self.root_dir:
+            return f"Created for another directory ({data.get('root')})"
+        self.cached = data.get("dirs", {})
+        return None
+
+    def save(self, keep_unvisited: bool = False):
+        """
+        Save listings of the directories visited during this run
+
+        Args:
+            keep_unvisited (bool): Keep previously cached listings of the
+                directories not visited during this run (partial walk)
+        """
+        dirs = self.visited
+        if keep_unvisited:
+            dirs = {**self.cached, **self.visited}
+        data = {
+            "version": self.version,
+            "root": self.root_dir,
+            "dirs": dirs,
+        }
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+    def list_dir(self, rel_dir: str) -> list[tuple[str, str]]:
+        """
+        Return the listing of `rel_dir` (relative to `self.root_dir`), reusing
+        the cached one if the directory has not changed since it was stored
+
+        Args:
+            rel_dir (str): Directory relative to `self.root_dir` ("" for root)
+
+        Returns:
+            list[tuple[str, str]]: (name, kind) pairs as returned by `scan_dir`
+        """
+        path = os.path.join(self.root_dir, rel_dir)
+        st = os.stat(path)
+        record = self.cached.get(rel_dir)
+        unchanged = (
+            record is not None
+            and record["mtime_ns"] == st.st_mtime_ns
+            and record["ino"] == st.st_ino
+        )
+        if unchanged:
+            entries = [tuple(entry) for entry in record["entries"]]
+        else:
+            entries = scan_dir(path)
+
+        with self._lock:
+            if unchanged:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if self.started_ns - st.st_mtime_ns >= self.racy_window_ns:
+                self.visited[rel_dir] = {
+                    "mtime_ns": st.st_mtime_ns,
+                    "ino": st.st_ino,
+                    "entries": entries,
+                }
+        return entries
@@ -0,0 +1,778 @@
+import copy
+from collections.abc import Callable, Mapping
+
+from chunked_list import ChunkedList
+from errors import MergeError
+
+# Operations of compiled patches (see `Patch.compile`)
+DELETE = "delete"  # Delete nested keys ('__delete_keys__')
+REMOVE = "remove"  # Remove a key or list items ('key__remove')
+APPEND = "append"  # Append list items ('key__append')
+UNION = "union"  # Append list items not yet present ('key__union')
+DROP = "drop"  # Remove a key ('key: false')
+SET = "set"  # Set a value
+MERGE_BY = "merge_by"  # Merge a list of dicts by a field ('key__merge_by')
+MERGE = "merge"  # Merge a dict into a dict (or set it if there is none)
+
+
+class Patch:
+    """
+    Override dictionary compiled into a program of merge operations
+
+    Compiling scans the override once, recognizing every instruction (like
+    'key__append') and precomputing what it needs (base keys, hash sets of
+    removed items, tries of deleted key paths, patches of nested dicts).
+    Applying a patch (`apply_patch`) is then a single pass over its operations,
+    so one parsed file may be compiled once and applied any number of times
+
+    Operations are stored as (operation, key, argument) tuples in the order the
+    merge semantics require: DELETE, REMOVE, APPEND, UNION, DROP and finally
+    SET/MERGE/MERGE_BY (in the order of the override keys)
+
+    Example:
+        >>> patch = Patch.compile({"a__append": [2], "b": {"c": 1}})
+        >>> patch
+        Patch([('append', 'a', [2]), ('merge', 'b', ({'c': 1}, Patch([...])))])
+        >>> apply_patch({"a": [1]}, patch)
+        {'a': [1, 2], 'b': {'c': 1}}
+    """
+
+    # Increase on any change of the compiled format (invalidates cached patches)
+    version = 3
+
+    __slots__ = ("data", "ops")
+
+    def __init__(self, data, ops: list[tuple] | None):
+        self.data = data  # Source (override) data
+        self.ops = ops  # None if `data` is not a dict (replaces the base)
+
+    def __repr__(self) -> str:
+        return f"Patch({self.ops!r})"
+
+    @classmethod
+    def compile(cls, data) -> "Patch":
+        """
+        Compile parsed YAML `data` (an override) into a Patch
+
+        Args:
+            data: Parsed YAML data
+
+        Returns:
+            Patch: Compiled patch
+        """
+        if not isinstance(data, dict):
+            return cls(data, None)
+
+        # Nested dicts are compiled using an explicit stack (no recursion), so
+        # deeply nested data does not hit the recursion limit
+        root = cls(data, [])
+        stack = [root]
+        while stack:
+            patch = stack.pop()
+            deletes = []
+            removes = []
+            appends = []
+            unions = []
+            drops = []
+            sets = []
+            merge_by = {}  # Base key: field to merge list items by
+            for key, val in patch.data.items():
+                if val is False:
+                    drops.append((DROP, key, None))
+
+                if key == "__delete_keys__":
+                    if val:
+                        deletes.append((DELETE, None, compile_key_paths(val)))
+                elif isinstance(key, str) and key.endswith("__remove"):
+                    base_key = key.removesuffix("__remove")
+                    if val is True:
+                        removes.append((REMOVE, base_key, None))
+                    elif isinstance(val, list):
+                        removes.append((REMOVE, base_key, split_hashable(val)))
+                elif isinstance(key, str) and key.endswith("__append"):
+                    appends.append((APPEND, key.removesuffix("__append"), val))
+                elif isinstance(key, str) and key.endswith("__union"):
+                    unions.append((UNION, key.removesuffix("__union"), val))
+                elif isinstance(key, str) and key.endswith("__merge_by"):
+                    if val is not None and val is not False:
+                        merge_by[key.removesuffix("__merge_by")] = val
+                elif val is False:
+                    continue
+                elif isinstance(val, dict):
+                    subpatch = cls(val, [])  # Operations are filled in later
+                    stack.append(subpatch)
+                    sets.append((MERGE, key, (val, subpatch)))
+                else:
+                    sets.append((SET, key, val))
+
+            for i, (_, key, _) in enumerate(sets if merge_by else ()):
+                if key in merge_by:
+                    items = patch.data[key]
+                    entry = compile_merge_by(key, merge_by[key], items)
+                    sets[i] = (MERGE_BY, key, entry)
+            patch.ops = deletes + removes + appends + unions + drops + sets
+        return root
+
+
+def merge_dicts_deep(
+    base: dict,
+    override: dict,
+    own_base: bool = False,
+    own_override: bool = False,
+) -> dict:
+    """
+    Recursively merges two dictionaries with support for advanced override logic
+
+    The `override` dictionary can:
+    - Add or replace values at any depth
+    - Remove entire keys using `key: false` or `key__remove: true`
+    - Remove specific list items using `key__remove: [items]`
+    - Append items to lists using `key__append: [items]`
+    - Append only items not yet present using `key__union: [items]`
+    - Merge lists of dicts item by item using `key__merge_by: field` (items
+        of `key` are deep-merged into the base items with the same `field`)
+    - Delete nested keys using `__delete_keys__` and dot notation ("\\." for
+        dots within keys, see `split_key_path`)
+
+    This function returns a new merged dictionary without modifying the
+    originals. Only the dictionaries along the paths touched by `override` are
+    copied (shallow), while unchanged subtrees of `base` are shared with the
+    result. Values taken from `override` are deep-copied, so the result never
+    aliases `override`
+
+    Since subtrees may be shared, merged results must not be modified in place
+    (copy the dictionaries along the path first, like `set_var_from_filename`
+    does, or `copy.deepcopy` the whole result)
+
+    Callers owning their arguments (nothing else references them, e.g. freshly
+    parsed YAML) may pass them without any copying at all:
+    - `own_base`: `base` (with all nested values) is modified in place and
+        returned, e.g. for an accumulator merging a chain of layers
+    - `own_override`: values of `override` are moved into the result as is
+
+    With both set the work is proportional to the size of `override` only
+
+    To apply the same override many times, compile it once with
+    `Patch.compile` and use `apply_patch` instead
+
+    Args:
+        base (dict): The base dictionary to be merged into
+        override (dict): The dictionary with overrides or modifications
+        own_base (bool): Modify `base` in place instead of copying
+        own_override (bool): Take values of `override` without copying
+
+    Returns:
+        dict: A new dictionary (or `base` itself if `own_base` is set)
+            representing the merged result
+
+    Raises:
+        MergeError: If an instruction can not be applied (e.g. '__append' to a
+            non-list value); `base` may be partially modified if `own_base` is
+            set
+    """
+    return apply_patch(base, Patch.compile(override), own_base, own_override)
+
+
+def apply_patch(
+    base: dict,
+    patch: Patch,
+    own_base: bool = False,
+    own_override: bool = False,
+) -> dict:
+    """
+    Apply a compiled `patch` to `base` (same as `merge_dicts_deep` with the
+    source override of the patch)
+
+    Args:
+        base (dict): The base dictionary to be merged into
+        patch (Patch): Compiled override
+        own_base (bool): Modify `base` in place instead of copying
+        own_override (bool): Take values of the patch without copying (the
+            patch must not be applied again)
+
+    Returns:
+        dict: A new dictionary (or `base` itself if `own_base` is set)
+            representing the merged result
+
+    Raises:
+        MergeError: If an instruction can not be applied (e.g. '__append' to a
+            non-list value); `base` may be partially modified if `own_base` is
+            set
+    """
+    take = take_value if own_override else copy.deepcopy
+
+    if patch.ops is None or not isinstance(base, dict):
+        # Non-dict types are fully replaced
+        return take(patch.data)
+
+    # Shallow copy: nested values are shared with `base` until modified
+    result = base if own_base else dict(base)
+
+    # Nested dicts are merged recursively up to RECURSION_DEPTH levels, deeper
+    # ones are paused there (see `apply_ops`) and continued from an explicit
+    # stack of (target, remaining operations), in the same order as a fully
+    # recursive merge, so any nesting depth is merged without RecursionError
+    stack = [(result, patch.ops)]
+    while stack:
+        target, ops = stack.pop()
+        paused = apply_ops(target, ops, own_base, own_override, take)
+        if paused is not None:
+            stack.extend(reversed(paused))
+
+    return result
+
+
+# Nesting levels merged by recursion before continuing from an explicit stack
+RECURSION_DEPTH = 64
+
+
+def apply_ops(
+    target: dict,
+    ops: list[tuple],
+    own_base: bool,
+    own_override: bool,
+    take: Callable,
+    depth: int = 0,
+) -> list[tuple[dict, list[tuple]]] | None:
+    """
+    Apply operations `ops` (of a Patch) to `target` (owned), recursing into
+    nested dicts while `depth` < RECURSION_DEPTH
+
+    Returns:
+        list | None: None if all operations are applied, otherwise the paused
+            levels, innermost first: (target, remaining operations) to be
+            continued by the caller (see `apply_patch`)
+    """
+    for i, (op, key, arg) in enumerate(ops):
+        if op == SET:
+            # Override scalar or non-dict types (lists are replaced entirely)
+            target[key] = take(arg)
+        elif op == MERGE:
+            val, subpatch = arg
+            base_val = target.get(key)
+            if isinstance(base_val, dict):
+                # Merge nested dicts (copy first unless owned)
+                child = base_val if own_base else dict(base_val)
+                target[key] = child
+                if depth < RECURSION_DEPTH:
+                    paused = apply_ops(
+                        child,
+                        subpatch.ops,
+                        own_base,
+                        own_override,
+                        take,
+                        depth + 1,
+                    )
+                else:
+                    paused = [(child, subpatch.ops)]
+                if paused is not None:
+                    paused.append((target, ops[i + 1 :]))  # Continue after the child
+                    return paused
+            else:
+                target[key] = take(val)
+        elif op == DROP:
+            target.pop(key, None)
+        elif op == REMOVE:
+            if arg is None:
+                target.pop(key, None)
+            elif isinstance(target.get(key), (list, ChunkedList)):
+                target[key] = remove_items(target[key], *arg)
+        elif op == APPEND:
+            append_items(target, key, arg, own_base, take)
+        elif op == UNION:
+            union_items(target, key, arg, take)
+        elif op == MERGE_BY:
+            merge_items_by(target, key, *arg, own_base, own_override)
+        elif op == DELETE:
+            delete_key_paths(target, arg, copy_nested=not own_base)
+    return None
+
+
+# Marks keys absent from a LayeredVars view
+MISSING = object()
+
+
+class LayeredVars(Mapping):
+    """
+    Lazily merged variables: read-only view of `parent` variables (a dict or
+    another LayeredVars) with a compiled `patch` applied on top
+
+    Every top-level key is affected by its own operations only (even
+    '__delete_keys__' paths start with one), so the merge is resolved per key,
+    when the key is accessed: its operations are applied to the parent value
+    (resolved the same way) and the result is memoized. Templates reading a few
+    keys of large variables do not pay for merging the rest. Values and the
+    order of keys are the same as `apply_patch` would produce, but merge errors
+    are raised when a key is accessed
+
+    Values of `patch` are shared with the results (not copied), so the patch
+    must not be applied elsewhere with `own_base`. Keys may be set (e.g.
+    'target_type'), which affects this view only
+
+    Example:
+        >>> layer = LayeredVars({"a": [1], "b": 2}, Patch.compile({"a__append": [2]}))
+        >>> layer["a"]  # Only "a" is merged
+        [1, 2]
+        >>> dict(layer)  # Merges all keys
+        {'a': [1, 2], 'b': 2}
+
+    Args:
+        parent (Mapping): Variables to apply `patch` to (not modified)
+        patch (Patch): Compiled override (of a dict)
+        path (str, optional): Source file of `patch` (set to merge errors)
+    """
+
+    def __init__(self, parent: Mapping, patch: Patch, path: str | None = None):
+        self.parent = parent
+        self.path = path
+        self._values = {}  # Resolved (or set) values, MISSING if absent
+        self._keys = None  # List of present keys (computed when iterating)
+
+        # Operations of `patch` by top-level key (in the same order)
+        self._key_ops: dict = {}
+        # Keys in the order `apply_patch` inserts them into the result: keys of
+        # `parent` keep their position unless removed as a whole (then set
+        # again), other keys follow in the order of the operation creating them
+        self._removed = set()
+        self._created: dict = {}
+        for op, key, arg in patch.ops:
+            if op == DELETE:
+                for key, node in arg.items():
+                    key_op = (DELETE, None, {key: node})
+                    self._key_ops.setdefault(key, []).append(key_op)
+                    if node is None:
+                        self._removed.add(key)
+                continue
+            self._key_ops.setdefault(key, []).append((op, key, arg))
+            if op == DROP or (op == REMOVE and arg is None):
+                self._removed.add(key)
+                self._created.pop(key, None)
+            elif op != REMOVE and key not in self._created:
+                self._created[key] = None
+
+    def resolve(self, key):
+        """
+        Return the merged value of `key` (MISSING if absent)
+
+        Raises:
+            MergeError: If an operation can not be applied
+        """
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        value = self.parent.get(key, MISSING)
+        ops = self._key_ops.get(key)
+        if ops is not None:
+            target = {} if value is MISSING else {key: value}
+            try:
+                target = apply_patch(target, Patch(None, ops), own_override=True)
+            except MergeError as error:
+                if error.path is None:
+                    error.path = self.path
+                raise
+            value = target.get(key, MISSING)
+
+        self._values[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.resolve(key)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._keys = None
+
+    def __contains__(self, key) -> bool:
+        return self.resolve(key) is not MISSING
+
+    def __iter__(self):
+        if self._keys is None:
+            candidates = dict.fromkeys(
+                key for key in self.parent if key not in self._removed
+            )
+            candidates.update(self._created)
+            candidates.update(dict.fromkeys(self._values))
+            self._keys = [key for key in candidates if key in self]
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(list(iter(self)))
+
+
+def compile_merge_by(base_key, field, items) -> tuple:
+    """
+    Compile the list `items` to be merged by `field` ('key__merge_by: field')
+
+    Returns:
+        tuple: (field, items, entries), entries being a (value of `field`,
+            Patch) pair for every item; the patch is None for items which can
+            not be matched (not a dict, no hashable `field`). Entries are None
+            if `items` is not a list
+
+    Raises:
+        MergeError: If `field` is not hashable (e.g. a list)
+    """
+    try:
+        hash(field)
+    except TypeError:
+        text = f"Error occured while parsing '{base_key}__merge_by' with value "
+        text += f"{field!r}: field must be a key (e.g. a string), not "
+        text += type(field).__name__
+        raise MergeError(text) from None
+    if not isinstance(items, list):
+        return field, items, None
+
+    entries = []
+    for item in items:
+        if isinstance(item, dict) and field in item:
+            value = item[field]
+            try:
+                hash(value)
+            except TypeError:
+                entries.append((None, None))
+                continue
+            entries.append((value, Patch.compile(item)))
+        else:
+            entries.append((None, None))
+    return field, items, entries
+
+
+def merge_items_by(
+    target: dict,
+    base_key,
+    field,
+    items,
+    entries: list | None,
+    own_base: bool,
+    own_override: bool,
+):
+    """
+    Process a 'key__merge_by: field' instruction (for the list of `items` set
+    to `key` in the same override)
+
+    Base list items are indexed by the value of `field` (dict lookup instead of
+    a scan per item, so merging is O(n+m)). Every item of `items`:
+    - Is deep-merged into the base item with the same `field` value (the first
+        one, if there are several)
+    - Is appended otherwise (and may be merged into by later items)
+
+    Base items that are not dicts or have no `field` are kept as is. A missing
+    base list is treated as an empty one. If the base value is not a list (or
+    `items` is not a list), raise MergeError
+
+    Args:
+        target (dict): The base dictionary to modify
+        base_key: Key to merge into
+        field: Key identifying the list items
+        items (list): Items to merge (from the override)
+        entries (list): Compiled items, see `compile_merge_by`
+        own_base (bool): Lists in `target` may be modified in place
+        own_override (bool): Take values of `items` without copying
+    """
+    key = f"{base_key}__merge_by"
+    if entries is None:
+        text = f"Error occured while parsing {key!r} with value {field!r}: "
+        text += f"only lists can be merged by a field, not {type(items).__name__}"
+        raise MergeError(text)
+
+    base_list = target.get(base_key, [])
+    if not isinstance(base_list, (list, ChunkedList)):
+        text = f"Error occured while parsing {key!r} with value {field!r}: "
+        text += f"can merge into lists only, not {type(base_list).__name__}"
+        raise MergeError(text)
+
+    take = take_value if own_override else copy.deepcopy
+    result = base_list if own_base and isinstance(base_list, list) else list(base_list)
+    index = {}  # Value of `field`: position in `result`
+    for pos, item in enumerate(result):
+        if isinstance(item, dict) and field in item:
+            try:
+                index.setdefault(item[field], pos)
+            except TypeError:
+                pass  # Unhashable value: can not be matched
+
+    for item, (value, patch) in zip(items, entries):
+        pos = None if patch is None else index.get(value)
+        if pos is not None:
+            result[pos] = apply_patch(result[pos], patch, own_base, own_override)
+            continue
+        if patch is not None:
+            index[value] = len(result)
+        result.append(take(item))
+
+    target[base_key] = result
+
+
+def take_value(value):
+    """
+    Return `value` as is (used instead of `copy.deepcopy` for owned data)
+    """
+    return value
+
+
+def delete_keys_with_dot_notation(
+    target: dict,
+    keys: list,
+    copy_nested: bool = True,
+):
+    """
+    Delete nested keys in `target` dictionary using dot-separated key paths
+
+    Same as `delete_key_paths` with the trie compiled from `keys`
+
+    Args:
+        target (dict): The dictionary to delete keys from
+        keys (list): List of dotted key strings, e.g. ['bgp.neighbors.10\\.1\\.1\\.1']
+        copy_nested (bool): Copy nested dictionaries before modifying them
+    """
+    delete_key_paths(target, compile_key_paths(keys), copy_nested)
+
+
+def compile_key_paths(keys: list) -> dict:
+    """
+    Compile dotted key paths (of '__delete_keys__') into a prefix trie, so paths
+    sharing a prefix (e.g. hundreds of 'bgp.neighbors.<ip>') are walked once
+
+    Paths below a deleted key are dropped, since they are deleted with it
+
+    Example:
+        >>> compile_key_paths(["bgp.neighbors.10\\.0\\.0\\.1", "bgp.asn", "ntp"])
+        {'bgp': {'neighbors': {'10.0.0.1': None}, 'asn': None}, 'ntp': None}
+
+    Args:
+        keys (list): List of dotted key strings (see `split_key_path`)
+
+    Returns:
+        dict: Trie mapping each key to the trie of its nested keys, or to None
+            if the key itself is to be deleted
+
+    Raises:
+        MergeError: If `keys` is neither a list nor a string
+    """
+    if isinstance(keys, str):
+        keys = [keys]
+    elif not isinstance(keys, list):
+        text = f"Error occured while parsing '__delete_keys__' with value {keys!r}: "
+        text += f"a list of key paths is expected, not {type(keys).__name__}"
+        raise MergeError(text)
+    trie = {}
+    for dotted_key in keys:
+        *parents, last = split_key_path(str(dotted_key))
+        node = trie
+        for part in parents:
+            node = node.setdefault(part, {})
+            if node is None:
+                break  # A parent key is deleted anyway
+        else:
+            node[last] = None
+    return trie
+
+
+def split_key_path(dotted_key: str) -> list[str]:
+    """
+    Split a dotted key path into keys. A dot preceded by a backslash is a part
+    of the key ("\\." for keys like IP addresses), "\\\\" stands for a single
+    backslash, other backslashes are kept as is
+
+    Example:
+        >>> split_key_path("bgp.neighbors.10\\.1\\.1\\.1")
+        ['bgp', 'neighbors', '10.1.1.1']
+    """
+    if "\\" not in dotted_key:
+        return dotted_key.split(".")
+
+    parts = []
+    part = []
+    i = 0
+    n = len(dotted_key)
+    while i < n:
+        char = dotted_key[i]
+        i += 1
+        if char == "\\" and dotted_key[i : i + 1] in (".", "\\"):
+            part.append(dotted_key[i])
+            i += 1
+        elif char == ".":
+            parts.append("".join(part))
+            part = []
+        else:
+            part.append(char)
+    parts.append("".join(part))
+    return parts
+
+
+def delete_key_paths(target: dict, trie: dict, copy_nested: bool = True):
+    """
+    Delete nested keys in `target` dictionary in a single traversal of the key
+    path `trie` (see `compile_key_paths`)
+
+    Nested dictionaries along the paths are replaced by their (shallow) copies
+    before deleting (unless `copy_nested` is False), so dictionaries shared with
+    other results are not modified
+
+    Args:
+        target (dict): The dictionary to delete keys from
+        trie (dict): Compiled key paths
+        copy_nested (bool): Copy nested dictionaries before modifying them
+    """
+    stack = [(target, trie)]
+    while stack:
+        cur, node = stack.pop()
+        for key, children in node.items():
+            if key not in cur:
+                continue  # Key path does not exist; nothing to delete
+            if children is None:
+                del cur[key]
+                continue
+            child = cur[key]
+            if not isinstance(child, dict):
+                continue
+            if copy_nested:
+                child = cur[key] = dict(child)
+            stack.append((child, children))
+
+
+def split_hashable(items: list) -> tuple[set, list]:
+    """
+    Split `items` into a set of hashable items and a list of unhashable ones
+    (dicts, lists)
+    """
+    hashable = set()
+    unhashable = []
+    for item in items:
+        try:
+            hashable.add(item)
+        except TypeError:
+            unhashable.append(item)
+    return hashable, unhashable
+
+
+def remove_items(items: list, hashable: set, unhashable: list) -> list:
+    """
+    Return a new list of `items` without those equal to any of the removals
+
+    Hashable removals are looked up in a set (O(n+m) instead of O(n*m)), while
+    unhashable ones (dicts, lists) are compared one by one
+
+    Args:
+        items (list): List to remove items from
+        hashable (set): Hashable items to remove
+        unhashable (list): Unhashable items to remove (see `split_hashable`)
+
+    Returns:
+        list: A new list
+    """
+    result = []
+    for item in items:
+        try:
+            if item in hashable:
+                continue
+        except TypeError:
+            pass  # Unhashable item: may only be equal to an unhashable removal
+        if unhashable and item in unhashable:
+            continue
+        result.append(item)
+    return result
+
+
+def append_items(target: dict, base_key, items, own_base: bool, take):
+    """
+    Process a 'key__append' instruction
+
+    - If base key is a list, append the new items (to a new list, unless
+        `own_base` is set; see `concat_items`)
+    - If base key is missing, create it as a new list
+    - If base key exists but is not a list (or `items` is not a list), raise
+        MergeError
+
+    Args:
+        target (dict): The base dictionary to modify
+        base_key: Key to append to (without the '__append' suffix)
+        items (list): Items to append
+        own_base (bool): Lists in `target` may be extended in place
+        take: Function to copy (or not) values taken from the override
+    """
+    key = f"{base_key}__append"
+    if not isinstance(items, list):
+        text = f"Error occured while parsing {key!r} with value {items!r}: "
+        text += f"only lists can be appended, not {type(items).__name__}"
+        raise MergeError(text)
+
+    if base_key not in target:
+        target[base_key] = take(items)
+    elif isinstance(target[base_key], (list, ChunkedList)):
+        if own_base and isinstance(target[base_key], list):
+            target[base_key].extend(take(items))
+        else:
+            # New list: the base one may be shared with other results
+            target[base_key] = concat_items(target[base_key], take(items))
+    else:
+        text = f"Error occured while parsing {key!r} with value {items!r}: "
+        text += f"can append to lists only, not {type(target[base_key]).__name__}"
+        raise MergeError(text)
+
+
+def union_items(target: dict, base_key, items, take):
+    """
+    Process a 'key__union' instruction
+
+    Like '__append', but only items not yet present in the base list (or earlier
+    in `items`) are appended, so layered lists stay free of duplicates. Hashable
+    items are tracked in an insertion-ordered set (dict), unhashable ones
+    (dicts, lists) are compared one by one
+
+    Args:
+        target (dict): The base dictionary to modify
+        base_key: Key to unite with (without the '__union' suffix)
+        items (list): Items to append (if not present)
+        take: Function to copy (or not) values taken from the override
+    """
+    key = f"{base_key}__union"
+    if not isinstance(items, list):
+        text = f"Error occured while parsing {key!r} with value {items!r}: "
+        text += f"only lists can be united, not {type(items).__name__}"
+        raise MergeError(text)
+
+    base_list = target.get(base_key, [])
+    if not isinstance(base_list, (list, ChunkedList)):
+        text = f"Error occured while parsing {key!r} with value {items!r}: "
+        text += f"can unite with lists only, not {type(base_list).__name__}"
+        raise MergeError(text)
+
+    hashable, seen_unhashable = split_hashable(base_list)
+    seen = dict.fromkeys(hashable)  # Insertion-ordered set
+    new_items = []
+    for item in items:
+        try:
+            if item in seen:
+                continue
+            seen[item] = None
+        except TypeError:
+            if item in seen_unhashable:
+                continue
+            seen_unhashable.append(item)
+        new_items.append(item)
+
+    # New list: the base one may be shared with other results
+    target[base_key] = concat_items(base_list, take(new_items))
+
+
+def concat_items(items, new_items: list):
+    """
+    Return a new list of `items` (a list or a ChunkedList) followed by
+    `new_items`
+
+    Large results (ChunkedList.`min_size` items or more) are returned as a
+    ChunkedList sharing the chunks of both instead of copying `items`, so lists
+    extended by every layer are not copied again and again
+
+    Returns:
+        list | ChunkedList: A new list
+    """
+    if len(items) + len(new_items) >= ChunkedList.min_size:
+        return ChunkedList.concat(items, new_items)
+    return [*items, *new_items]
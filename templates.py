@@ -0,0 +1,274 @@
+import os
+import json
+import shutil
+from pprint import pformat
+from collections import Counter
+
+import jinja2
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    ModuleLoader,
+    select_autoescape,
+)
+
+from chunked_list import materialize
+from config import Config
+from errors import TemplateError
+
+
+log = Config.log
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """
+    Jinja bytecode cache stored in files, reused between runs and processes
+
+    Compiled templates are stored per template name and path (and Jinja
+    version) together with the checksum of the template source, which is checked
+    on load, so changed templates are compiled again. Jinja itself rejects
+    bytecode written by another Python version
+
+    Hits and misses are counted and logged at debug level. Cache errors (e.g. a
+    read-only directory) are ignored, templates are compiled from source then
+
+    Example:
+        >>> cache = TemplateBytecodeCache("output_data/.cache/jinja")
+        >>> env = Environment(loader=..., bytecode_cache=cache)
+    """
+
+    def __init__(self, directory: str):
+        super().__init__(directory)
+        self.hits = 0
+        self.misses = 0
+
+    def get_cache_key(self, name: str, filename: str | None = None) -> str:
+        return super().get_cache_key(f"{jinja2.__version__}|{name}", filename)
+
+    def get_bucket(self, environment, name, filename, source):
+        bucket = super().get_bucket(environment, name, filename, source)
+        if bucket.code is None:
+            self.misses += 1
+            log.debug(f"Jinja bytecode cache miss: {name}")
+        else:
+            self.hits += 1
+            log.debug(f"Jinja bytecode cache hit: {name}")
+        return bucket
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError as error:
+            log.debug(f"Jinja bytecode cache not written: {error}")
+
+
+def create_bytecode_cache() -> TemplateBytecodeCache | None:
+    """
+    Create the bytecode cache in Config.`cache_dir` (None if it is disabled by
+    Config.`jinja_cache` or the directory can not be created)
+    """
+    if not Config.jinja_cache:
+        return None
+    directory = os.path.join(Config.cache_dir, "jinja")
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as error:
+        log.warning(f"Jinja bytecode cache disabled: {error}")
+        return None
+    return TemplateBytecodeCache(directory)
+
+
+class TemplateRegistry:
+    """
+    Templates used by targets, loaded from `env`
+
+    Every distinct template is compiled once (by `env`, which keeps compiled
+    templates). With Config.`frozen_templates` every template is loaded once
+    per run, and the loaded template (or the error loading it, e.g. a missing
+    "base.j2") is reused for all targets using it, without looking it up in
+    `env` again. Otherwise every lookup goes to `env`, which checks whether the
+    template source changed (a stat of the template and its includes)
+
+    The number of targets successfully rendered with each template is counted
+    in `usage` (see `record_use`)
+
+    Example:
+        >>> registry = TemplateRegistry(create_environment())
+        >>> template = registry.get("cisco_ios/base.j2")
+    """
+
+    def __init__(self, env: Environment, frozen: bool | None = None):
+        self.env = env
+        self.frozen = Config.frozen_templates if frozen is None else frozen
+        self.templates: dict[str, jinja2.Template | TemplateError] = {}
+        self.usage: Counter[str] = Counter()  # Template name: rendered targets
+
+    def get(self, name: str) -> jinja2.Template:
+        """
+        Return the template `name`
+
+        Raises:
+            TemplateError: If the template can not be loaded
+        """
+        template = self.templates.get(name)
+        if template is None:
+            template = self.load(name)
+            if self.frozen:
+                self.templates[name] = template
+        if isinstance(template, TemplateError):
+            raise template.clone()  # Not the cached error (see `clone`)
+        return template
+
+    def record_use(self, name: str):
+        """
+        Count a target rendered and saved with the template `name`
+        """
+        self.usage[name] += 1
+
+    def usage_lines(self) -> list[str]:
+        """
+        Return a line per used template: its name and the number of targets
+        """
+        return [f"{name}: {count} targets" for name, count in self.usage.most_common()]
+
+    def load(self, name: str) -> jinja2.Template | TemplateError:
+        """
+        Load the template `name` from `env` (return the error if it fails)
+        """
+        try:
+            return self.env.get_template(name)
+        except Exception as error:
+            text = f"Error while loading template: {type(error).__name__}: {error}"
+            return TemplateError(text, name)
+
+
+def create_environment(use_compiled: bool = True) -> Environment:
+    """
+    Create the Jinja environment used for rendering
+
+    Templates compiled by `compile_templates` are loaded (by a ModuleLoader,
+    without parsing) if `use_compiled` and Config.`compiled_templates` are set
+    and they are up to date with the sources in Config.`input_templates_dir`.
+    Otherwise templates are loaded from the sources (with the bytecode cache,
+    see `create_bytecode_cache`)
+
+    Args:
+        use_compiled (bool): Whether compiled templates may be used
+    """
+    loader = FileSystemLoader(Config.input_templates_dir)
+    bytecode_cache = None
+    compiled_dir = os.path.join(Config.cache_dir, "templates")
+    if use_compiled and Config.compiled_templates and os.path.isdir(compiled_dir):
+        reason = check_compiled_templates(compiled_dir, loader)
+        if reason is None:
+            log.info(f"Using compiled templates from {compiled_dir}")
+            loader = ModuleLoader(compiled_dir)
+        else:
+            log.warning(f"Not using compiled templates ({reason})")
+    if not isinstance(loader, ModuleLoader):
+        bytecode_cache = create_bytecode_cache()
+
+    env = Environment(
+        loader=loader,
+        autoescape=select_autoescape(disabled_extensions=("j2")),
+        bytecode_cache=bytecode_cache,
+        # Loaded templates (and includes) are not checked for changes on use
+        auto_reload=not Config.frozen_templates,
+    )
+    # Merged lists may be ChunkedLists (see `merge.concat_items`), output as lists
+    env.policies["json.dumps_kwargs"] = {"sort_keys": True, "default": list}
+    env.filters["pprint"] = lambda value: pformat(materialize(value))
+    return env
+
+
+def compile_templates() -> int:
+    """
+    Compile all templates of Config.`input_templates_dir` into Python modules
+    (in "templates" subdirectory of Config.`cache_dir`) to be loaded by
+    `create_environment`, along with a manifest of the sources used
+
+    The previous compiled set is replaced only if all templates compile
+
+    Returns:
+        int: Number of compiled templates
+
+    Raises:
+        jinja2.TemplateSyntaxError: If a template can not be compiled
+    """
+    env = create_environment(use_compiled=False)
+    compiled_dir = os.path.join(Config.cache_dir, "templates")
+    tmp_dir = f"{compiled_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    sources = template_sources(env.loader)
+    try:
+        env.compile_templates(
+            tmp_dir, zip=None, log_function=log.debug, ignore_errors=False
+        )
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    manifest = {
+        "version": 1,
+        "jinja": jinja2.__version__,
+        "templates": sources,
+    }
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as file:
+        json.dump(manifest, file, separators=(",", ":"))
+
+    shutil.rmtree(compiled_dir, ignore_errors=True)
+    os.replace(tmp_dir, compiled_dir)
+    return len(sources)
+
+
+def template_sources(loader: FileSystemLoader) -> dict[str, list[int]]:
+    """
+    Return size and mtime (ns) of every template source found by `loader`
+    (the files are stat'ed, not read)
+    """
+    result = {}
+    for name in loader.list_templates():
+        for searchpath in loader.searchpath:
+            # The first search path containing the template is used (as Jinja)
+            try:
+                st = os.stat(os.path.join(searchpath, *name.split("/")))
+            except FileNotFoundError:
+                continue
+            result[name] = [st.st_size, st.st_mtime_ns]
+            break
+    return result
+
+
+def check_compiled_templates(
+    compiled_dir: str,
+    loader: FileSystemLoader,
+) -> str | None:
+    """
+    Check that templates in `compiled_dir` were compiled (by the same Jinja
+    version) from the current sources of `loader`: same set of templates with
+    the same sizes and mtimes
+
+    Returns:
+        str: Reason why compiled templates are stale, None if they are fresh
+    """
+    try:
+        with open(os.path.join(compiled_dir, "manifest.json"), "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError) as error:
+        return f"no valid manifest: {error}"
+
+    if manifest.get("version") != 1 or manifest.get("jinja") != jinja2.__version__:
+        return "compiled by another version"
+    try:
+        sources = template_sources(loader)
+    except OSError as error:
+        return str(error)
+    compiled = manifest.get("templates") or {}
+    changed = set(sources).symmetric_difference(compiled)
+    changed.update(
+        name for name in sources if compiled.get(name, sources[name]) != sources[name]
+    )
+    if changed:
+        return f"changed: {', '.join(sorted(changed))}"
+    return None
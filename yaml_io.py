@@ -0,0 +1,459 @@
+import io
+import os
+import json
+import re
+import pickle
+import time
+import hashlib
+import threading
+
+import yaml
+
+from chunked_list import ChunkedList
+
+try:
+    from yaml import CSafeLoader, CDumper
+except ImportError:  # PyYAML built without libyaml
+    CSafeLoader = CDumper = None
+
+
+def make_inventory_loader(base: type) -> type:
+    """
+    Create a subclass of the `base` loader class that resolves plain scalars
+    using the YAML 1.2 core schema only: null, bool, int and float (everything
+    else, e.g. timestamps like "2024-01-01", sexagesimal numbers like "22:30",
+    "yes"/"no" or "0755", stays a string). The "<<" merge key is supported
+
+    Resolvers are compiled once (when the class is created) and checked against
+    the first character of a scalar, so most strings are resolved after a
+    single dictionary lookup
+    """
+    loader = type(f"Inventory{base.__name__}", (base,), {})
+    loader.yaml_implicit_resolvers = {}
+
+    implicit_resolvers = [
+        (
+            "tag:yaml.org,2002:null",
+            r"~|null|Null|NULL|",
+            ["~", "n", "N", ""],
+        ),
+        (
+            "tag:yaml.org,2002:bool",
+            r"true|True|TRUE|false|False|FALSE",
+            list("tTfF"),
+        ),
+        (
+            "tag:yaml.org,2002:int",
+            r"[-+]?(?:0|[1-9][0-9]*)|0o[0-7]+|0x[0-9a-fA-F]+",
+            list("-+0123456789"),
+        ),
+        (
+            "tag:yaml.org,2002:float",
+            r"[-+]?(?:\.[0-9]+|[0-9]+\.[0-9]*)(?:[eE][-+]?[0-9]+)?"
+            r"|[-+]?[0-9]+[eE][-+]?[0-9]+"
+            r"|[-+]?\.(?:inf|Inf|INF)|\.(?:nan|NaN|NAN)",
+            list("-+.0123456789"),
+        ),
+        (
+            "tag:yaml.org,2002:merge",
+            r"<<",
+            ["<"],
+        ),
+    ]
+    for tag, regexp, first in implicit_resolvers:
+        loader.add_implicit_resolver(tag, re.compile(rf"^(?:{regexp})$"), first)
+    return loader
+
+
+SafeLoader = yaml.SafeLoader
+InventorySafeLoader = make_inventory_loader(SafeLoader)
+if CSafeLoader is not None:
+    InventoryCSafeLoader = make_inventory_loader(CSafeLoader)
+
+
+def make_plain_dumper(base: type) -> type:
+    """
+    Create a subclass of the `base` dumper class that writes objects occurring
+    several times as copies, without anchors and aliases ("&id001"/"*id001")
+
+    Merged data shares objects between keys (e.g. a list referenced by a YAML
+    alias under several keys is moved into the result as is), which the
+    dumper would otherwise write as aliases
+    """
+    return type(
+        f"Plain{base.__name__}",
+        (base,),
+        {"ignore_aliases": lambda self, data: True},
+    )
+
+
+PlainDumper = make_plain_dumper(yaml.Dumper)
+PlainCDumper = None if CDumper is None else make_plain_dumper(CDumper)
+
+# Merged lists may be ChunkedLists (see `merge.concat_items`), dumped as lists
+for dumper in (PlainDumper, PlainCDumper):
+    if dumper is not None:
+        dumper.add_representer(ChunkedList, yaml.SafeDumper.represent_list)
+
+
+class YamlBackend:
+    """
+    YAML loader/dumper classes used for all parsing and dumping
+
+    The libyaml based `CSafeLoader` and `CDumper` (often 5-10 times faster) are
+    used when PyYAML is built with them, otherwise the pure-Python `SafeLoader`
+    and `Dumper`. Both produce the same data, and errors of both are subclasses
+    of `yaml.YAMLError`
+
+    Input data (`vars.yaml` and target files) is parsed by `DataLoader`, which
+    depends on the selected profile:
+    - "safe": same as `yaml.safe_load` (YAML 1.1 types)
+    - "inventory": YAML 1.2 core schema types only (str, int, float, bool and
+        null), see `make_inventory_loader`
+
+    Example:
+        >>> YamlBackend.select("python", profile="inventory")
+        >>> YamlBackend.load("a: 22:30", YamlBackend.DataLoader)
+        {'a': '22:30'}
+    """
+
+    libyaml_available = CSafeLoader is not None
+    cache: "YamlCache | None" = None  # Persistent cache used by `load_file`
+
+    name = "libyaml" if libyaml_available else "python"
+    profile = "safe"
+    Loader = CSafeLoader if libyaml_available else SafeLoader
+    DataLoader = Loader
+    Dumper = PlainCDumper if libyaml_available else PlainDumper
+
+    @classmethod
+    def select(cls, backend: str = "auto", profile: str = "safe") -> str | None:
+        """
+        Select the backend and the profile (for input data) to use
+
+        Args:
+            backend (str): "auto" (libyaml if available), "libyaml" or "python"
+            profile (str): "safe" or "inventory"
+
+        Returns:
+            str: Warning text if the requested backend can not be used, else None
+        """
+        warnings = []
+        if backend not in ("auto", "libyaml", "python"):
+            warnings.append(f"Unknown YAML backend {backend!r}, using 'auto'")
+            backend = "auto"
+        elif backend == "libyaml" and not cls.libyaml_available:
+            warnings.append("YAML backend 'libyaml' is not available, using 'python'")
+        if profile not in ("safe", "inventory"):
+            warnings.append(f"Unknown YAML profile {profile!r}, using 'safe'")
+            profile = "safe"
+
+        if backend != "python" and cls.libyaml_available:
+            cls.name = "libyaml"
+            cls.Loader = CSafeLoader
+            cls.Dumper = PlainCDumper
+            inventory_loader = InventoryCSafeLoader
+        else:
+            cls.name = "python"
+            cls.Loader = SafeLoader
+            cls.Dumper = PlainDumper
+            inventory_loader = InventorySafeLoader
+
+        cls.profile = profile
+        cls.DataLoader = inventory_loader if profile == "inventory" else cls.Loader
+        return "\n".join(warnings) or None
+
+    @classmethod
+    def load(cls, stream, loader: type | None = None):
+        """
+        Parse a YAML document (string or file) like `yaml.safe_load` (using the
+        `loader` class, `cls.Loader` by default)
+        """
+        return yaml.load(stream, Loader=loader or cls.Loader)
+
+    @classmethod
+    def dump(cls, data, stream=None):
+        """
+        Serialize `data` like `yaml.dump` (to `stream` or return a string), but
+        without anchors and aliases (see `make_plain_dumper`)
+        """
+        return yaml.dump(data, stream, Dumper=cls.Dumper)
+
+    @classmethod
+    def load_file(
+        cls,
+        path: str,
+        loader: type | None = None,
+        compiler: type | None = None,
+    ):
+        """
+        Parse a YAML file (using the `loader` class, `cls.Loader` by default),
+        using the persistent `cls.cache` (if set)
+
+        Args:
+            path (str): Path to the YAML file
+            loader (type): Loader class
+            compiler (type): Class with a `compile(data)` classmethod and a
+                `version` attribute (e.g. `merge.Patch`). If given, the parsed
+                data is compiled and the result is returned (and cached) instead
+
+        Raises:
+            FileNotFoundError: If the file does not exist
+            yaml.YAMLError: If the file is not a valid YAML
+        """
+        loader = loader or cls.Loader
+        if cls.cache is not None:
+            return cls.cache.load_file(path, loader, compiler)
+        with open(path, "rb") as file:
+            data = cls.load(file, loader)
+        return compiler.compile(data) if compiler is not None else data
+
+
+class YamlCache:
+    """
+    Persistent cache of parsed YAML files (pickled parse results)
+
+    Every source file gets an entry file in `cache_dir` (named by a hash of the
+    absolute path, the loader and the compiler in use), storing its size,
+    `st_mtime_ns`, SHA-256 of the content and the parsed (and compiled) data.
+    Cached data is used if size and mtime are unchanged or, when they differ (or
+    `trust_mtime` is False, e.g. for filesystems with unreliable mtimes), if the
+    content hash is unchanged. Files modified shortly before they were cached
+    are always hashed
+
+    Entries are written atomically, so the cache may be used from several
+    threads (and processes) at once. `gc` removes entries of deleted/changed
+    files and evicts the oldest ones to keep the cache within `max_bytes`.
+    The total size of the cache is kept in an index file, updated by
+    `update_size` after every run writing entries, so the cache is walked only
+    when it grows over `max_bytes`
+
+    Example:
+        >>> cache = YamlCache("output_data/.cache/yaml", max_bytes=2**20)
+        >>> data = cache.load_file("input_data/vars.yaml", YamlBackend.Loader)
+    """
+
+    version = 1
+    racy_window_ns = 2 * 10**9
+    size_filename = "size.json"  # Index of the total size of entries
+
+    def __init__(self, cache_dir: str, max_bytes: int, trust_mtime: bool = True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.trust_mtime = trust_mtime
+        self.hits = 0
+        self.misses = 0
+        self.bytes_written = 0
+        self.size_change = 0  # Bytes written minus sizes of replaced entries
+        self._used: set[str] = set()  # Entries used during this run
+        self._lock = threading.Lock()
+
+    def entry_path(self, path: str, loader: type, compiler: type | None = None) -> str:
+        """
+        Return the path of the cache entry for the source file `path` parsed by
+        the `loader` class (and compiled by the `compiler` class)
+        """
+        key = f"{self.version}\0{loader.__name__}\0{os.path.abspath(path)}"
+        if compiler is not None:
+            key += f"\0{compiler.__name__}\0{compiler.version}"
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest[2:] + ".pickle")
+
+    def load_file(self, path: str, loader: type, compiler: type | None = None):
+        """
+        Return data of the YAML file `path` parsed by the `loader` class and
+        compiled by the `compiler` class, if any (from the cache if possible)
+
+        Raises:
+            FileNotFoundError: If the file does not exist
+            yaml.YAMLError: If the file is not a valid YAML
+        """
+        st = os.stat(path)
+        entry_path = self.entry_path(path, loader, compiler)
+        entry = self.read_entry(entry_path)
+        with self._lock:
+            self._used.add(entry_path)
+
+        if (
+            entry is not None
+            and self.trust_mtime
+            and entry["size"] == st.st_size
+            and entry["mtime_ns"] == st.st_mtime_ns
+            and not self.is_racy(entry)
+        ):
+            self.count(hit=True)
+            return entry["data"]
+
+        with open(path, "rb") as file:
+            content = file.read()
+        sha256 = hashlib.sha256(content).hexdigest()
+        if entry is not None and entry["sha256"] == sha256:
+            self.count(hit=True)
+            data = entry["data"]
+            if entry["mtime_ns"] == st.st_mtime_ns and not self.is_racy(entry):
+                return data
+        else:
+            self.count(hit=False)
+            stream = io.BytesIO(content)
+            stream.name = path  # Shown in error messages
+            data = YamlBackend.load(stream, loader)
+            if compiler is not None:
+                data = compiler.compile(data)
+
+        entry = {
+            "path": os.path.abspath(path),
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha256": sha256,
+            "cached_ns": time.time_ns(),
+            "data": data,
+        }
+        self.write_entry(entry_path, entry)
+        return data
+
+    def is_racy(self, entry: dict) -> bool:
+        """
+        Check if the source file was modified too shortly before the entry was
+        cached for its mtime to be trusted (it might change within the same tick)
+        """
+        return entry["cached_ns"] - entry["mtime_ns"] < self.racy_window_ns
+
+    def count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @staticmethod
+    def read_entry(entry_path: str) -> dict | None:
+        """
+        Read a cache entry (None if it is missing or can not be read)
+        """
+        try:
+            with open(entry_path, "rb") as file:
+                return pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception:  # Corrupted/incompatible entry: parse again
+            return None
+
+    def write_entry(self, entry_path: str, entry: dict):
+        """
+        Write a cache entry atomically (errors are ignored, caching is optional)
+        """
+        try:
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            try:
+                replaced = os.path.getsize(entry_path)
+            except FileNotFoundError:
+                replaced = 0
+            tmp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as file:
+                pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+                size = file.tell()
+            os.replace(tmp_path, entry_path)
+        except (OSError, pickle.PicklingError, RecursionError):
+            return  # RecursionError: data nested too deep for pickle
+        with self._lock:
+            self.bytes_written += size
+            self.size_change += size - replaced
+
+    def update_size(self) -> tuple[int, int] | None:
+        """
+        Add the size of entries written during this run to the size index of
+        the cache, garbage-collecting it (see `gc`) only if it exceeds
+        `self.max_bytes` or its size is not known yet
+
+        Returns:
+            tuple[int, int] | None: Result of `gc`, None if it was not needed
+        """
+        try:
+            with open(os.path.join(self.cache_dir, self.size_filename)) as file:
+                index = json.load(file)
+            total = index["bytes"] + self.size_change
+            known = index["version"] == self.version
+        except (OSError, ValueError, KeyError, TypeError):
+            total, known = 0, False
+        if not known or total > self.max_bytes:
+            return self.gc(full=False)
+        self.write_size(total)
+        self.size_change = 0
+        return None
+
+    def write_size(self, total: int):
+        """
+        Write the size index (errors are ignored, it is rebuilt by `gc`)
+        """
+        size_path = os.path.join(self.cache_dir, self.size_filename)
+        tmp_path = f"{size_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump({"version": self.version, "bytes": total}, file)
+            os.replace(tmp_path, size_path)
+        except OSError:
+            pass
+
+    def gc(self, full: bool = True) -> tuple[int, int]:
+        """
+        Garbage-collect the cache
+
+        Args:
+            full (bool): Also remove entries of deleted or changed source files
+                (requires reading every entry), otherwise only evict the oldest
+                entries not used during this run to fit into `self.max_bytes`
+
+        Returns:
+            tuple[int, int]: Number of removed entries and size of the cache
+                (bytes) afterwards
+        """
+        entries = []  # (mtime, size, path)
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                entry_path = os.path.join(dirpath, filename)
+                if dirpath == self.cache_dir and filename == self.size_filename:
+                    continue
+                if full and self.is_stale(entry_path):
+                    removed += self.remove(entry_path)
+                    continue
+                try:
+                    st = os.stat(entry_path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry_path))
+
+        total = sum(size for _, size, _ in entries)
+        # Oldest entries not used during this run go first
+        entries.sort(key=lambda item: (item[2] in self._used, item[0]))
+        for _, size, entry_path in entries:
+            if total <= self.max_bytes:
+                break
+            removed += self.remove(entry_path)
+            total -= size
+        self.write_size(total)
+        self.size_change = 0
+        return removed, total
+
+    def is_stale(self, entry_path: str) -> bool:
+        """
+        Check if the entry is unreadable or its source file is missing/changed
+        """
+        if not entry_path.endswith(".pickle"):
+            return True  # Leftover temporary file
+        entry = self.read_entry(entry_path)
+        if entry is None:
+            return True
+        try:
+            st = os.stat(entry["path"])
+        except OSError:
+            return True
+        return entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns
+
+    @staticmethod
+    def remove(entry_path: str) -> int:
+        try:
+            os.remove(entry_path)
+        except OSError:
+            return 0
+        return 1